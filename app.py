@@ -4,15 +4,27 @@ import bcrypt
 import jwt
 import datetime
 from flask import make_response
-from models import User, DreamEntry, db_session
+from models import User, DreamEntry, db_session, read_db_session
 from functools import wraps
 import os
 import json
-from dream_routes import dream_bp
-from mood_insights import MoodInsights
-from database import init_db
+from dream_routes import dream_bp, get_mood_analyzer
+from export_routes import export_bp
+from import_routes import import_bp
+from search_routes import search_bp
+from job_routes import job_bp
+from auth_middleware import load_principal, token_claims
+import mood_aggregates
+import theme_model
+import idempotency
+import http_cache
+import metrics
+from database import SessionLocal, init_db
+from write_queue import writer_from_env
 import logging
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from pagination import (PaginationError, encode_cursor, keyset_filter,
+                        parse_date, parse_limit)
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -28,18 +40,36 @@ CORS(app, resources={
     r"/*": {
         "origins": "*",
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key"]
     }
 })
 
+# Fields a client may request from /get_dreams
+DREAM_FIELDS = ('dream_id', 'dream_text', 'mood_score', 'timestamp')
+
 # Generate secret key
 app.config['SECRET_KEY'] = os.urandom(24)
 
 # Initialize database
 init_db()
 
+# Request, SQL and analysis metrics on /metrics
+metrics.init_app(app)
+
+# gzip for large JSON responses
+http_cache.init_app(app)
+
 # Register blueprints
 app.register_blueprint(dream_bp)
+app.register_blueprint(export_bp)
+app.register_blueprint(import_bp)
+app.register_blueprint(search_bp)
+app.register_blueprint(job_bp)
+
+# Optional warm-up so `gunicorn --preload` workers share the loaded models
+if os.environ.get('PRELOAD_MODELS') == '1':
+    from startup import warmup
+    warmup()
 
 # Explicit static file handling
 @app.route('/static/<path:filename>')
@@ -65,13 +95,14 @@ def check_static_files():
 @app.after_request
 def after_request(response):
     if request.path.startswith('/static/'):
-        logger.info(f"Static file request: {request.path} - Status: {response.status_code}")
+        logger.debug(f"Static file request: {request.path} - Status: {response.status_code}")
     return response
 
 # Database session cleanup
 @app.teardown_appcontext
 def cleanup(resp_or_exc):
     db_session.remove()
+    read_db_session.remove()
 
 # Authentication decorator
 def token_required(f):
@@ -86,6 +117,10 @@ def token_required(f):
                 token = auth_header.split(" ")[1]
                 data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
                 
+                current_user = load_principal(data)
+                if not current_user:
+                    return jsonify({'message': 'User not found'}), 401
+                
                 # Increase buffer time to 30 minutes
                 exp_timestamp = datetime.datetime.fromtimestamp(data['exp'])
                 time_until_expiry = exp_timestamp - datetime.datetime.utcnow()
@@ -93,14 +128,10 @@ def token_required(f):
                 if time_until_expiry < datetime.timedelta(minutes=30):
                     # Generate new token with longer expiration
                     new_token = jwt.encode({
-                        'username': data['username'],
+                        **token_claims(current_user),
                         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24),
                         'iat': datetime.datetime.utcnow()
                     }, app.config['SECRET_KEY'])
-                
-                current_user = db_session.query(User).filter_by(username=data['username']).first()
-                if not current_user:
-                    return jsonify({'message': 'User not found'}), 401
                     
                 response = make_response(f(current_user, *args, **kwargs))
                 if new_token:
@@ -185,7 +216,7 @@ def login():
         
         if user and bcrypt.checkpw(data['password'].encode('utf-8'), user.password_hash):
             token = jwt.encode({
-                'username': user.username,
+                **token_claims(user),
                 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
             }, app.config['SECRET_KEY'])
             
@@ -203,6 +234,36 @@ def login():
         logger.error(f"Login error: {str(e)}")
         return jsonify({'message': f'Error during login: {str(e)}'}), 500
 
+def _save_dream(session, fields):
+    """
+    Insert a scored dream and fold it into the derived tables; the caller
+    commits. Takes plain fields so a failed group commit can retry the insert.
+    With an idempotency key the response is stored in the same transaction.
+    """
+    dream = DreamEntry(
+        user_id=fields['user_id'],
+        dream_text=fields['dream_text'],
+        mood_score=fields['mood_score']
+    )
+    dream.set_analysis(fields['components'], fields['analysis_version'])
+    session.add(dream)
+    session.flush()
+    mood_aggregates.record_dream(session, dream)
+    http_cache.bump_version(session, fields['user_id'])
+    if fields.get('idempotency_key'):
+        idempotency.remember(session, fields['user_id'], fields['idempotency_key'],
+                             fields['request_hash'], 201, _dream_added(dream.dream_id))
+    return dream.dream_id
+
+def _dream_added(dream_id):
+    return {
+        'message': 'Dream added successfully',
+        'dream_id': dream_id
+    }
+
+# Opt-in group commit (GROUP_COMMIT=1): concurrent inserts share one transaction
+dream_writer = writer_from_env(SessionLocal, _save_dream)
+
 @app.route('/add_dream', methods=['POST'])
 @token_required
 def add_dream(current_user):
@@ -211,24 +272,58 @@ def add_dream(current_user):
         
         if not data or 'dream_text' not in data:
             return jsonify({'message': 'Dream text is required'}), 400
+
+        # A retried request with the same Idempotency-Key gets the first response
+        try:
+            key = idempotency.request_key()
+        except idempotency.IdempotencyError as e:
+            return jsonify({'message': str(e)}), 400
+        request_hash = idempotency.request_hash(request.get_data()) if key else None
+        if key:
+            record = idempotency.find(db_session, current_user.user_id, key)
+            if record is not None:
+                return idempotency.replay(record, request_hash)
             
-        new_dream = DreamEntry(
-            user_id=current_user.user_id,
-            dream_text=data['dream_text'],
-            mood_score=data.get('mood_score', 0.0)
-        )
+        # Score the text once here; analysis endpoints read the stored values
+        mood_analyzer = get_mood_analyzer()
+        components = mood_analyzer.analyze_components(data['dream_text'])
+        fields = {
+            'user_id': current_user.user_id,
+            'dream_text': data['dream_text'],
+            'mood_score': data.get('mood_score', components['combined_score']),
+            'components': components,
+            'analysis_version': mood_analyzer.lexicon_version,
+            'idempotency_key': key,
+            'request_hash': request_hash
+        }
         
         try:
-            db_session.add(new_dream)
-            db_session.commit()
+            if dream_writer is not None:
+                dream_id = dream_writer.submit(fields)
+            else:
+                dream_id = _save_dream(db_session, fields)
+                db_session.commit()
             logger.info(f"Dream added for user: {current_user.username}")
             
-            response = jsonify({
-                'message': 'Dream added successfully',
-                'dream_id': new_dream.dream_id
-            })
+            response = jsonify(_dream_added(dream_id))
             return response, 201
+
+        except IntegrityError as e:
+            # Lost a race with a concurrent request carrying the same key
+            db_session.rollback()
+            record = idempotency.find(db_session, current_user.user_id, key) if key else None
+            if record is not None:
+                return idempotency.replay(record, request_hash)
+            logger.error(f"Database error while adding dream: {str(e)}")
+            return jsonify({'message': 'Database error occurred'}), 500
             
+        except TimeoutError as e:
+            # The write was withdrawn from the queue, so a retry cannot duplicate it
+            logger.error(f"Timed out adding dream: {str(e)}")
+            response = jsonify({'message': 'Server is busy, the dream was not saved; please retry'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+
         except SQLAlchemyError as e:
             db_session.rollback()
             logger.error(f"Database error while adding dream: {str(e)}")
@@ -242,57 +337,190 @@ def add_dream(current_user):
 @app.route('/get_dreams', methods=['GET'])
 @token_required
 def get_dreams(current_user):
+    """
+    List the user's dreams newest first, one page at a time.
+    Query parameters: limit, cursor (next_cursor of the previous page),
+    start/end (ISO-8601 dates) and fields (comma separated).
+    """
     try:
-        dreams = db_session.query(DreamEntry).filter_by(user_id=current_user.user_id).all()
-        logger.info(f"Retrieved dreams for user: {current_user.username}")
-        return jsonify({
-            'dreams': [{
-                'dream_id': dream.dream_id,
-                'dream_text': dream.dream_text,
-                'mood_score': dream.mood_score,
-                'timestamp': dream.timestamp.isoformat()
-            } for dream in dreams]
-        })
-        
+        # Revalidation costs one lookup of the user's data version
+        etag = http_cache.make_etag('get_dreams', current_user.user_id,
+                                    http_cache.user_version(db_session, current_user.user_id),
+                                    request.full_path)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+
+        limit = parse_limit(request.args.get('limit'))
+        start = parse_date(request.args.get('start'), 'start')
+        end = parse_date(request.args.get('end'), 'end')
+        fields = _parse_dream_fields(request.args.get('fields'))
+
+        # dream_id and timestamp are always selected because the cursor needs them
+        columns = [DreamEntry.dream_id, DreamEntry.timestamp] + [
+            getattr(DreamEntry, field) for field in fields
+            if field not in ('dream_id', 'timestamp')
+        ]
+        query = db_session.query(*columns).filter(DreamEntry.user_id == current_user.user_id)
+        if start:
+            query = query.filter(DreamEntry.timestamp >= start)
+        if end:
+            query = query.filter(DreamEntry.timestamp < end)
+        query = keyset_filter(query, DreamEntry.timestamp, DreamEntry.dream_id,
+                              request.args.get('cursor'))
+
+        # Fetch one extra row to know whether another page exists
+        rows = query.order_by(
+            DreamEntry.timestamp.desc(), DreamEntry.dream_id.desc()
+        ).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        dreams = []
+        for row in rows:
+            values = row._asdict()
+            if values['timestamp'] is not None:
+                values['timestamp'] = values['timestamp'].isoformat()
+            dreams.append({field: values[field] for field in fields})
+
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].dream_id)
+
+        logger.info(f"Retrieved {len(dreams)} dreams for user: {current_user.username}")
+        return http_cache.with_etag(jsonify({
+            'dreams': dreams,
+            'next_cursor': next_cursor
+        }), etag)
+
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
     except Exception as e:
         logger.error(f"Error retrieving dreams: {str(e)}")
         return jsonify({'message': f'Error retrieving dreams: {str(e)}'}), 500
 
+def _parse_dream_fields(value):
+    """Validate the comma separated `fields` parameter of /get_dreams"""
+    if not value:
+        return list(DREAM_FIELDS)
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in DREAM_FIELDS]
+    if unknown:
+        raise PaginationError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+@app.route('/delete_dream/<int:dream_id>', methods=['DELETE'])
+@token_required
+def delete_dream(current_user, dream_id):
+    try:
+        dream = db_session.query(DreamEntry).filter(
+            DreamEntry.dream_id == dream_id,
+            DreamEntry.user_id == current_user.user_id
+        ).first()
+        if not dream:
+            return jsonify({'message': 'Dream not found'}), 404
+
+        # The dream, its day's mood aggregate and the theme model change in one transaction
+        mood_aggregates.remove_dream(db_session, dream)
+        theme_model.remove_dream(db_session, dream)
+        http_cache.bump_version(db_session, current_user.user_id)
+        db_session.commit()
+        logger.info(f"Dream {dream_id} deleted for user: {current_user.username}")
+        return jsonify({'message': 'Dream deleted successfully', 'dream_id': dream_id})
+
+    except SQLAlchemyError as e:
+        db_session.rollback()
+        logger.error(f"Database error while deleting dream: {str(e)}")
+        return jsonify({'message': 'Database error occurred'}), 500
+
 @app.route('/get_insights', methods=['GET'])
 @token_required
 def get_insights(current_user):
+    """Insights with mood_trends and themes JSON-encoded as strings; see /v2/get_insights"""
     try:
-        insights = MoodInsights(current_user.user_id)
+        etag = _insights_etag(1, current_user.user_id)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+
+        insights = _insights(current_user.user_id)
         
         # Convert complex objects to JSON serializable formats if needed
-        mood_trends = insights.get_mood_trends()
+        mood_trends = insights['mood_trends']
         if not isinstance(mood_trends, str):
             mood_trends = json.dumps(mood_trends)  # Serialize if it's an object/dict
 
-        themes = insights.find_recurring_themes()
+        themes = insights['themes']
         if not isinstance(themes, str):
             themes = json.dumps(themes)  # Serialize if it's an object/dict
 
-        feedback = insights.generate_feedback()
+        feedback = insights['feedback']
         if not isinstance(feedback, str):
             feedback = str(feedback)  # Convert to string as fallback
         
         logger.info(f"Generated insights for user: {current_user.username}")
-        return jsonify({
+        return http_cache.with_etag(jsonify({
             'mood_trends': mood_trends,
             'themes': themes,
             'feedback': feedback
-        })
+        }), etag)
+    except Exception as e:
+        logger.error(f"Error generating insights: {str(e)}")
+        return jsonify({'message': f'Error generating insights: {str(e)}'}), 500
+
+@app.route('/v2/get_insights', methods=['GET'])
+@token_required
+def get_insights_v2(current_user):
+    """Insights as plain JSON: mood_trends is an object and themes a list (or null)"""
+    try:
+        etag = _insights_etag(2, current_user.user_id)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+
+        insights = _insights(current_user.user_id)
+        logger.info(f"Generated insights for user: {current_user.username}")
+        return http_cache.with_etag(jsonify(insights), etag)
     except Exception as e:
         logger.error(f"Error generating insights: {str(e)}")
         return jsonify({'message': f'Error generating insights: {str(e)}'}), 500
 
+def _insights(user_id):
+    from mood_insights import MoodInsights
+    insights = MoodInsights(user_id)
+    return {
+        'mood_trends': insights.get_mood_trends(),
+        'themes': insights.find_recurring_themes(),
+        'feedback': insights.generate_feedback()
+    }
+
+def _insights_etag(payload_version, user_id):
+    """
+    Insights change with the user's data and, as the 30-day trend window
+    slides, with time; responses are revalidated at least every hour.
+    """
+    hour = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H')
+    return http_cache.make_etag('get_insights', payload_version, user_id,
+                                http_cache.user_version(db_session, user_id), hour)
+
+@app.route('/dream_patterns', methods=['GET'])
+@token_required
+def dream_patterns(current_user):
+    """Monthly dream counts and mood averages plus the mood distribution, computed in SQL"""
+    try:
+        from dream_analysis import DreamQueryAnalyzer
+        analyzer = DreamQueryAnalyzer(read_db_session, current_user.user_id)
+        return jsonify({
+            'patterns': analyzer.analyze_patterns(),
+            'mood_distribution': analyzer.get_mood_distribution()
+        })
+    except SQLAlchemyError as e:
+        logger.error(f"Database error while analyzing dream patterns: {str(e)}")
+        return jsonify({'message': 'Database error occurred'}), 500
+
 @app.route('/refresh_token', methods=['POST'])
 @token_required
 def refresh_token(current_user):
     try:
         new_token = jwt.encode({
-            'username': current_user.username,
+            **token_claims(current_user),
             'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1),
             'iat': datetime.datetime.utcnow()
         }, app.config['SECRET_KEY'])
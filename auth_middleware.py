@@ -1,8 +1,119 @@
 from functools import wraps
 from flask import request, jsonify
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
 import jwt
+import threading
+import time
+import metrics
 from models import User, db_session
 
+# The minimal authenticated user handed to routes as `current_user`
+Principal = namedtuple('Principal', ['user_id', 'username'])
+
+
+class PrincipalCache:
+    """
+    Per-process TTL + LRU cache of token subject (username) -> Principal.
+    Entries are dropped when the user row changes or is deleted in this
+    process; the TTL bounds how long other worker processes can lag behind.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(username, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, principal):
+        with self._lock:
+            self._entries[principal.username] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(principal.username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters: every hit is a users-table lookup saved"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'db_lookups_saved': self.hits,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+principal_cache = PrincipalCache()
+
+metrics.registry.add_collector(lambda: [
+    ('cache_hits_total', {'cache': 'principal'}, principal_cache.hits),
+    ('cache_misses_total', {'cache': 'principal'}, principal_cache.misses)
+])
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_updated_user(mapper, connection, target):
+    history = attributes.get_history(target, 'username')
+    for username in list(history.deleted or []) + [target.username]:
+        principal_cache.invalidate(username)
+
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user(mapper, connection, target):
+    principal_cache.invalidate(target.username)
+
+
+def token_claims(user):
+    """Identity claims put in every issued token"""
+    return {'username': user.username, 'user_id': user.user_id}
+
+
+def load_principal(data):
+    """
+    Resolve decoded token claims to a Principal, or None if the user is gone.
+    Cached; tokens issued before user_id was added to the claims still work.
+    """
+    principal = principal_cache.get(data['username'])
+    if principal is None:
+        if 'user_id' in data:
+            user = db_session.get(User, data['user_id'])
+        else:
+            user = db_session.query(User).filter_by(username=data['username']).first()
+        if not user or user.username != data['username']:
+            return None
+        principal = Principal(user.user_id, user.username)
+        principal_cache.put(principal)
+
+    # A username re-registered after deletion must not accept the old user's tokens
+    if data.get('user_id', principal.user_id) != principal.user_id:
+        return None
+    return principal
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -21,7 +132,7 @@ def token_required(f):
         try:
             from app import app  # Import app here to avoid circular import
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = db_session.query(User).filter_by(username=data['username']).first()
+            current_user = load_principal(data)
             if not current_user:
                 return jsonify({'message': 'User not found'}), 401
         except jwt.ExpiredSignatureError:
@@ -0,0 +1,347 @@
+"""
+Microbenchmarks for the analysis and insights engines.
+
+Every case runs at each size on synthetic dreams from generate_dreams() and
+reports wall time (best of --repeat runs), peak traced memory and
+throughput. Database-backed cases use a throwaway SQLite file, never the
+database named by DATABASE_URL.
+
+    python benchmark.py --sizes 100,10000 --output results.json
+    python benchmark.py --compare baseline.json --threshold 0.15
+
+With --compare the exit status is 1 when any case is slower or uses more
+memory than the baseline by more than the threshold. Per-text scoring cases
+time at most --max-texts texts per size; their throughput is unaffected.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (100, 10000, 1000000)
+
+FILLER_WORDS = (
+    'the', 'a', 'i', 'was', 'in', 'and', 'then', 'with', 'my', 'house',
+    'street', 'night', 'room', 'someone', 'door', 'light', 'car', 'friend',
+    'city', 'old', 'walking', 'saw', 'there', 'felt', 'very', 'suddenly'
+)
+
+MOOD_WORDS = (
+    'happy', 'calm', 'wonderful', 'peaceful', 'joy', 'beautiful',
+    'scared', 'sad', 'angry', 'terrible', 'anxious', 'dark'
+)
+
+# Minimal stand-in for DreamEntry rows, as DreamAnalyzer reads them
+DreamRow = namedtuple('DreamRow', ['timestamp', 'mood_score'])
+
+
+def generate_dreams(n, seed=0, min_words=20, max_words=80, theme_density=0.1,
+                    mood_density=0.05, span_days=365, end=None):
+    """
+    Deterministic synthetic dreams: a dict of equal-length lists with
+    dream_text, timestamp (ascending, spread over span_days up to `end`) and
+    mood_score. theme_density and mood_density are the fractions of words
+    drawn from the theme lexicon and from sentiment-bearing words.
+    """
+    from theme_lexicon import default_lexicon
+
+    rng = np.random.default_rng(seed)
+    end = end or datetime.datetime.utcnow()
+    theme_terms = np.array([term for terms in default_lexicon().terms.values() for term in terms])
+    filler = np.array(FILLER_WORDS)
+    moods = np.array(MOOD_WORDS)
+
+    lengths = rng.integers(min_words, max_words + 1, size=n)
+    words = filler[rng.integers(len(filler), size=lengths.sum())].astype(object)
+    kind = rng.random(len(words))
+    is_theme = kind < theme_density
+    is_mood = (kind >= theme_density) & (kind < theme_density + mood_density)
+    words[is_theme] = theme_terms[rng.integers(len(theme_terms), size=is_theme.sum())]
+    words[is_mood] = moods[rng.integers(len(moods), size=is_mood.sum())]
+
+    offsets = np.sort(rng.uniform(0, span_days * 86400, size=n))
+    start = end - datetime.timedelta(days=span_days)
+    return {
+        'dream_text': [' '.join(chunk) for chunk in np.split(words, np.cumsum(lengths)[:-1])],
+        'timestamp': [start + datetime.timedelta(seconds=float(s)) for s in offsets],
+        'mood_score': rng.uniform(-1, 1, size=n).round(4).tolist()
+    }
+
+
+class BenchmarkContext:
+    """Shared state of one run: the synthetic data and the database per size"""
+
+    def __init__(self, dreams, max_texts, span_days):
+        from dream_routes import get_mood_analyzer
+        self.dreams = dreams
+        self.max_texts = max_texts
+        self.span_days = span_days
+        self.analyzer = get_mood_analyzer()
+        self._users = {}
+
+    def texts(self, n):
+        return self.dreams['dream_text'][:n]
+
+    def user_for(self, n):
+        """A user owning the first n synthetic dreams, created on first use"""
+        if n not in self._users:
+            self._users[n] = _load_user(self.dreams, n)
+        return self._users[n]
+
+
+def _load_user(dreams, n):
+    """Insert a user with n dreams and their aggregates; returns the user_id"""
+    from sqlalchemy import insert
+    from models import DreamEntry, User, db_session
+    import mood_aggregates
+
+    user = User(username=f'benchmark-{n}', password_hash='-')
+    db_session.add(user)
+    db_session.flush()
+    for start in range(0, n, 10000):
+        db_session.execute(insert(DreamEntry.__table__), [{
+            'user_id': user.user_id,
+            'dream_text': dreams['dream_text'][i],
+            'timestamp': dreams['timestamp'][i],
+            'mood_score': dreams['mood_score'][i]
+        } for i in range(start, min(start + 10000, n))])
+    mood_aggregates.rebuild_user(db_session, user.user_id)
+    db_session.commit()
+    return user.user_id
+
+
+# Each case takes (context, n) and returns (run, items): `run` is timed and
+# `items` is the number of dreams it processes
+
+def case_analyze_mood(ctx, n):
+    texts = ctx.texts(min(n, ctx.max_texts))
+
+    def run():
+        for text in texts:
+            ctx.analyzer.analyze_mood(text)
+    return run, len(texts)
+
+
+def case_get_detailed_analysis(ctx, n):
+    texts = ctx.texts(min(n, ctx.max_texts))
+
+    def run():
+        # Measure the uncached path
+        ctx.analyzer.analysis_cache.clear()
+        for text in texts:
+            ctx.analyzer.get_detailed_analysis(text)
+    return run, len(texts)
+
+
+def case_get_mood_trends(ctx, n):
+    from mood_insights import MoodInsights
+    insights = MoodInsights(ctx.user_for(n))
+    return lambda: insights.get_mood_trends(days=ctx.span_days + 1), n
+
+
+def case_find_recurring_themes(ctx, n):
+    from mood_insights import MoodInsights
+    insights = MoodInsights(ctx.user_for(n))
+    # The first call builds the stored theme model; requests then read it
+    insights.find_recurring_themes()
+    return insights.find_recurring_themes, n
+
+
+def case_theme_model_build(ctx, n):
+    from theme_model import IncrementalThemeModel
+    texts = ctx.texts(n)
+    return lambda: IncrementalThemeModel().partial_fit(texts), n
+
+
+def case_analyze_patterns(ctx, n):
+    from dream_analysis import DreamAnalyzer
+    rows = [DreamRow(ts, mood) for ts, mood in
+            zip(ctx.dreams['timestamp'][:n], ctx.dreams['mood_score'][:n])]
+    return DreamAnalyzer(rows).analyze_patterns, n
+
+
+def case_analyze_patterns_sql(ctx, n):
+    from dream_analysis import DreamQueryAnalyzer
+    from models import read_db_session
+    analyzer = DreamQueryAnalyzer(read_db_session, ctx.user_for(n))
+
+    def run():
+        analyzer.analyze_patterns()
+        analyzer.get_mood_distribution()
+    return run, n
+
+
+def case_prepare_data(ctx, n):
+    import pandas as pd
+    from dream_visualizer import DreamVisualizer
+    frame = pd.DataFrame({
+        'dream_text': ctx.texts(n),
+        'mood': ctx.dreams['mood_score'][:n],
+        'created_at': ctx.dreams['timestamp'][:n]
+    })
+    return lambda: DreamVisualizer().prepare_data(frame), n
+
+
+CASES = {
+    'analyze_mood': case_analyze_mood,
+    'get_detailed_analysis': case_get_detailed_analysis,
+    'get_mood_trends': case_get_mood_trends,
+    'find_recurring_themes': case_find_recurring_themes,
+    'theme_model_build': case_theme_model_build,
+    'analyze_patterns': case_analyze_patterns,
+    'analyze_patterns_sql': case_analyze_patterns_sql,
+    'prepare_data': case_prepare_data
+}
+
+
+def measure(run, repeat=3, memory=True):
+    """Best wall time over `repeat` runs and, in one extra run, peak traced memory"""
+    seconds = min(_timed(run) for _ in range(repeat))
+    peak_bytes = None
+    if memory:
+        # Tracing slows execution, so it never overlaps the timed runs
+        tracemalloc.start()
+        try:
+            run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def _timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def run_benchmarks(sizes, cases, repeat=3, memory=True, seed=0, max_texts=10000,
+                   span_days=365):
+    ctx = BenchmarkContext(generate_dreams(max(sizes), seed=seed, span_days=span_days),
+                           max_texts, span_days)
+    results = []
+    for n in sizes:
+        for name in cases:
+            run, items = CASES[name](ctx, n)
+            seconds, peak_bytes = measure(run, repeat, memory)
+            results.append({
+                'case': name,
+                'n': n,
+                'items': items,
+                'seconds': seconds,
+                'peak_bytes': peak_bytes,
+                'throughput': items / seconds if seconds else None
+            })
+            print(f"{name:<24} n={n:<9} {seconds:10.4f}s "
+                  f"{_format_bytes(peak_bytes):>10} {results[-1]['throughput'] or 0:14.1f}/s")
+    return {
+        'meta': {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+            'max_texts': max_texts
+        },
+        'results': results
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """Cases whose time or peak memory grew by more than `threshold` over the baseline"""
+    base = {(r['case'], r['n']): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        previous = base.get((result['case'], result['n']))
+        if previous is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            old, new = previous.get(metric), result.get(metric)
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append({
+                    'case': result['case'],
+                    'n': result['n'],
+                    'metric': metric,
+                    'baseline': old,
+                    'current': new,
+                    'ratio': new / old
+                })
+    return regressions
+
+
+def _format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024 or unit == 'GiB':
+            return f'{value:.1f}{unit}'
+        value /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analysis and insights engines')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated dream counts (default: 100,10000,1000000)')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help=f'comma separated subset of: {", ".join(CASES)}')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case; the best is kept')
+    parser.add_argument('--max-texts', type=int, default=10000,
+                        help='texts timed per size by the per-text scoring cases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write results')
+    parser.add_argument('--results', help='compare an existing results file instead of running')
+    parser.add_argument('--compare', metavar='BASELINE', help='baseline results to check against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown/memory growth before flagging (default: 0.1)')
+    args = parser.parse_args()
+
+    cases = [name.strip() for name in args.cases.split(',') if name.strip()]
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    if args.results:
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        logging.disable(logging.WARNING)
+        with tempfile.TemporaryDirectory() as tmp:
+            # Must be set before the first import of database
+            os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'benchmark.db')}"
+            from database import init_db
+            init_db()
+            results = run_benchmarks(
+                sorted(int(size) for size in args.sizes.split(',')), cases,
+                repeat=args.repeat, memory=not args.no_memory, seed=args.seed,
+                max_texts=args.max_texts
+            )
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['case']} n={r['n']} {r['metric']}: "
+                  f"{r['baseline']:.4g} -> {r['current']:.4g} ({r['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,94 @@
-from sqlalchemy import create_engine
+import datetime
+import os
+from sqlalchemy import DateTime, bindparam, create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
-# Database URL - replace with your actual database URL
-SQLALCHEMY_DATABASE_URL = "sqlite:///./dream_journal.db"
+# Database URL; set DATABASE_URL to use another database (e.g. PostgreSQL)
+SQLALCHEMY_DATABASE_URL = os.environ.get('DATABASE_URL', "sqlite:///./dream_journal.db")
+
+# Hosting providers hand out postgres:// URLs, which SQLAlchemy no longer accepts
+if SQLALCHEMY_DATABASE_URL.startswith('postgres://'):
+    SQLALCHEMY_DATABASE_URL = 'postgresql://' + SQLALCHEMY_DATABASE_URL[len('postgres://'):]
+
+# Log every SQL statement only when asked to
+SQL_ECHO = os.environ.get('SQL_ECHO') == '1'
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
+# Applied to every SQLite connection. WAL lets readers run alongside the single
+# writer; synchronous=NORMAL is durable in WAL mode apart from a power loss.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+}
+
+def _is_sqlite(url):
+    return make_url(url).get_backend_name() == 'sqlite'
+
+def _is_memory_sqlite(url):
+    return _is_sqlite(url) and make_url(url).database in (None, '', ':memory:')
+
+def _set_sqlite_pragmas(read_only):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+    return on_connect
+
+def _create_engine(url, read_only=False):
+    """Engine with pooling and, for SQLite, the pragmas above on every connection"""
+    if _is_sqlite(url):
+        new_engine = create_engine(
+            url,
+            echo=SQL_ECHO,
+            connect_args={"check_same_thread": False},
+            **({} if _is_memory_sqlite(url) else {
+                'pool_size': POOL_SIZE, 'max_overflow': MAX_OVERFLOW
+            })
+        )
+        event.listen(new_engine, 'connect', _set_sqlite_pragmas(read_only))
+        return new_engine
+
+    return create_engine(
+        url,
+        echo=SQL_ECHO,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        execution_options={'postgresql_readonly': True} if read_only else {}
+    )
 
 # Create SQLAlchemy engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = _create_engine(SQLALCHEMY_DATABASE_URL)
+
+# Read-only engine for analytics queries; its connections never take the write lock
+read_engine = engine if _is_memory_sqlite(SQLALCHEMY_DATABASE_URL) else \
+    _create_engine(SQLALCHEMY_DATABASE_URL, read_only=True)
+
+# Pooled connections must not be shared with processes forked after startup
+# (e.g. gunicorn --preload workers)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: (
+        engine.dispose(close=False), read_engine.dispose(close=False)
+    ))
 
 # Create SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# Request-scoped sessions; app.py removes them when each request ends
+db_session = scoped_session(sessionmaker(bind=engine))
+read_db_session = scoped_session(ReadSessionLocal)
 
 # Create Base class
 Base = declarative_base()
@@ -19,13 +96,79 @@ Base = declarative_base()
 # Define init_db function
 def init_db():
     # Import all models here
-    from models import User, DreamEntry  # Make sure these models are defined
+    from models import User, DreamEntry, MoodDailyAggregate, ThemeModelState, IdempotencyRecord  # Make sure these models are defined
     Base.metadata.create_all(bind=engine)
 
+    # create_all skips columns and indexes of tables that already exist
+    _add_missing_columns(engine, User.__table__)
+    _add_missing_columns(engine, DreamEntry.__table__)
+    _add_missing_columns(engine, ThemeModelState.__table__)
+    _add_missing_columns(engine, IdempotencyRecord.__table__)
+    for index in DreamEntry.__table__.indexes | IdempotencyRecord.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+    # Dreams stored while timestamp was nullable get one, so every row paginates
+    filled = _fill_missing_timestamps(engine)
+
+    # New aggregate columns start out NULL, so every row is recomputed
+    added = _add_missing_columns(engine, MoodDailyAggregate.__table__)
+    _backfill_mood_aggregates(engine, force=bool(added) or filled > 0)
+
+    import search_index
+    search_index.ensure_index(engine)
+
+def _add_missing_columns(bind, table):
+    """
+    Add nullable columns declared on the model but missing from the database;
+    returns the names of the added columns
+    """
+    existing = {column['name'] for column in inspect(bind).get_columns(table.name)}
+    added = []
+    with bind.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                added.append(column.name)
+    return added
+
+def _fill_missing_timestamps(bind):
+    """
+    Give dreams without a timestamp the time of the migration, as the column
+    default would have; returns the number of dreams changed. SQLite cannot
+    add NOT NULL to an existing column, so older databases rely on this.
+    """
+    with bind.begin() as conn:
+        # Their owners' responses change, so cached ETags must not match
+        conn.execute(text(
+            'UPDATE users SET data_version = COALESCE(data_version, 0) + 1 WHERE user_id IN '
+            '(SELECT user_id FROM dream_entries WHERE timestamp IS NULL)'
+        ))
+        result = conn.execute(
+            text('UPDATE dream_entries SET timestamp = :now WHERE timestamp IS NULL').bindparams(
+                bindparam('now', type_=DateTime)
+            ),
+            {'now': datetime.datetime.utcnow()}
+        )
+    return result.rowcount
+
+def _backfill_mood_aggregates(bind, force=False):
+    """Fill the aggregate table when it is empty (or `force`) but dreams already exist"""
+    import mood_aggregates
+    from models import DreamEntry, MoodDailyAggregate
+    session = SessionLocal(bind=bind)
+    try:
+        if (force or session.query(MoodDailyAggregate).first() is None) and \
+                session.query(DreamEntry.dream_id).first() is not None:
+            mood_aggregates.rebuild_all(session)
+            session.commit()
+    finally:
+        session.close()
+
 # Dependency
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
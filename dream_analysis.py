@@ -1,4 +1,5 @@
 from collections import defaultdict
+from sqlalchemy import case, func
 import datetime
 
 class DreamAnalyzer:
@@ -61,4 +62,72 @@ class DreamAnalyzer:
             for mood, count in mood_counts.items()
         }
         
-        return mood_distribution
\ No newline at end of file
+        return mood_distribution
+
+
+class DreamQueryAnalyzer:
+    """
+    DreamAnalyzer computed in the database for one user's dreams. Only
+    timestamp and mood_score are read, grouped by month or folded into
+    CASE bucket counts, so the cost grows with the number of months rather
+    than the number of dreams. Return shapes match DreamAnalyzer.
+    """
+
+    def __init__(self, session, user_id):
+        self.session = session
+        self.user_id = user_id
+
+    def _month(self):
+        from models import DreamEntry
+        if self.session.get_bind().dialect.name == 'postgresql':
+            return func.to_char(DreamEntry.timestamp, 'YYYY-MM')
+        return func.strftime('%Y-%m', DreamEntry.timestamp)
+
+    def analyze_patterns(self):
+        """Analyze patterns in dream entries"""
+        from models import DreamEntry
+        month = self._month().label('month')
+        rows = self.session.query(
+            month,
+            func.count().label('dreams'),
+            func.avg(DreamEntry.mood_score).label('average_mood')
+        ).filter(
+            DreamEntry.user_id == self.user_id
+        ).group_by(month).order_by(month).all()
+
+        if not rows:
+            return {"message": "No dreams recorded yet"}
+
+        monthly_counts = {row.month: row.dreams for row in rows}
+        total_dreams = sum(monthly_counts.values())
+        return {
+            'total_dreams': total_dreams,
+            'mood_trends': {row.month: row.average_mood for row in rows},
+            'dreams_per_month': monthly_counts,
+            'average_dreams_per_month': round(total_dreams / len(monthly_counts), 2)
+        }
+
+    def get_mood_distribution(self):
+        """Calculate distribution of mood categories"""
+        from models import DreamEntry
+        score = DreamEntry.mood_score
+        buckets = {
+            'very_positive': score >= 0.5,
+            'positive': (score >= 0.1) & (score < 0.5),
+            'neutral': (score > -0.1) & (score < 0.1),
+            'negative': (score > -0.5) & (score <= -0.1),
+            'very_negative': score <= -0.5
+        }
+        # Unscored dreams fall in no bucket, so they are left out of the total too
+        row = self.session.query(
+            func.count(score).label('total'),
+            *[func.sum(case((condition, 1), else_=0)).label(mood)
+              for mood, condition in buckets.items()]
+        ).filter(DreamEntry.user_id == self.user_id).one()
+
+        if not row.total:
+            return {}
+        return {
+            mood: (getattr(row, mood) / row.total) * 100
+            for mood in buckets if getattr(row, mood)
+        }
@@ -1,80 +1,212 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, make_response, url_for
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from models import DreamEntry, db_session
-from mood_analyzer import MoodAnalyzer
-import nltk
-import pandas as pd
-import io
+from auth_middleware import token_required
+from pagination import PaginationError, parse_date
+from render_cache import render_cache, make_key
+from render_pool import render_pool, RenderPoolBusy, RenderTimeout
 import base64
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-import matplotlib.pyplot as plt
+import http_cache
+import metrics
+import mood_aggregates
+import threading
 
 # Create Blueprint instead of APIRouter
 dream_bp = Blueprint('dreams', __name__)
 
-# Initialize NLTK data at startup
-try:
-    nltk.data.find('sentiment/vader_lexicon.zip')
-except LookupError:
-    nltk.download('vader_lexicon')
-    nltk.download('punkt')
+# Single MoodAnalyzer reused by every request, created on first use so that
+# importing the app does not load NLTK, TextBlob, pandas or scikit-learn
+_mood_analyzer = None
+_mood_analyzer_lock = threading.Lock()
 
-# Create a single instance of MoodAnalyzer to be reused
-mood_analyzer = MoodAnalyzer()
+def get_mood_analyzer():
+    global _mood_analyzer
+    if _mood_analyzer is None:
+        with _mood_analyzer_lock:
+            if _mood_analyzer is None:
+                from mood_analyzer import MoodAnalyzer
+                _mood_analyzer = MoodAnalyzer()
+    return _mood_analyzer
+
+def _cache_counters():
+    """Hit/miss counters of the analysis and render caches for /metrics"""
+    counters = [
+        ('cache_hits_total', {'cache': 'render'}, render_cache.hits),
+        ('cache_misses_total', {'cache': 'render'}, render_cache.misses)
+    ]
+    if _mood_analyzer is not None:
+        stats = _mood_analyzer.analysis_cache.stats()
+        counters += [
+            ('cache_hits_total', {'cache': 'analysis'}, stats['hits']),
+            ('cache_misses_total', {'cache': 'analysis'}, stats['misses'])
+        ]
+    return counters
+
+metrics.registry.add_collector(_cache_counters)
 
 @dream_bp.route("/dreams/analysis/<int:dream_id>", methods=['GET'])
-def get_dream_analysis(dream_id):
+@token_required
+def get_dream_analysis(current_user, dream_id):
+    """Detailed mood analysis of one of the user's dreams"""
     try:
-        dream = db_session.query(DreamEntry).filter(DreamEntry.dream_id == dream_id).first()
-        if not dream:
+        owner = http_cache.dream_version(db_session, dream_id)
+        # Other users' dreams are reported as missing, like unknown ids
+        if owner is None or owner[0] != current_user.user_id:
             return jsonify({"error": "Dream not found"}), 404
-            
-        analysis = mood_analyzer.get_detailed_analysis(dream.dream_text)
-        return jsonify(analysis)
+
+        # The analysis depends on the owner's data, the analyzer and the theme lexicon
+        from mood_analyzer import ANALYZER_VERSION
+        mood_analyzer = get_mood_analyzer()
+        etag = http_cache.make_etag('analysis', dream_id, *owner, ANALYZER_VERSION,
+                                    mood_analyzer.lexicon.version)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+
+        dream = db_session.get(DreamEntry, dream_id)
+        components = dream.get_analysis(mood_analyzer.lexicon_version)
+        if components is None:
+            # Unscored dreams, or dreams scored by another analyzer or lexicon
+            # version, are scored once more and saved
+            components = mood_analyzer.analyze_components(dream.dream_text)
+            dream.set_analysis(components, mood_analyzer.lexicon_version)
+            db_session.commit()
+
+        analysis = mood_analyzer.get_detailed_analysis(dream.dream_text, components)
+        return http_cache.with_etag(jsonify(analysis), etag)
     except Exception as e:
         return jsonify({"error": f"Analysis failed: {str(e)}"}), 500
 
 @dream_bp.route("/dreams/visualizations", methods=['GET'])
-def get_dream_visualizations():
+@token_required
+def get_dream_visualizations(current_user):
+    """
+    Mood pattern figures plus a text report for the user's dreams,
+    optionally limited to ?start=/&end= (ISO-8601), widened to whole days
+    like the daily rollup the charts read. Renders are cached per data
+    version; pass ?format=url to get PNG URLs instead of inline base64.
+    """
     try:
-        # Convert matplotlib figures to base64 strings
-        results = mood_analyzer.visualize_mood_patterns()
-        
-        # Save current figures as base64 strings
-        visualizations = {}
-        for fig_num in plt.get_fignums():
-            fig = plt.figure(fig_num)
-            visualizations[f'figure_{fig_num}'] = _figure_to_base64(fig)
-        
-        # Clear all figures to free memory
-        plt.close('all')
-        
-        return jsonify({
-            'visualizations': visualizations,
-            'report': results.get('report', '')
-        })
+        start, end = mood_aggregates.day_window(*_window())
+        etag, last_modified, count = render_version('visualizations', current_user.user_id, start, end)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag, last_modified)
+
+        cached = render_cache.get_render(etag)
+        if cached is None:
+            # Rendering runs in the render pool, off the request thread; the
+            # job streams the dream texts from the database itself
+            from dream_visualizer import MIN_DREAMS, render_mood_patterns
+            from mood_analyzer import dream_text_source
+            if count < MIN_DREAMS:
+                return _too_few_dreams(MIN_DREAMS)
+            results = render_pool.run(render_mood_patterns,
+                                      dream_text_source(current_user.user_id, start, end),
+                                      get_mood_analyzer().load_daily_frame(current_user.user_id, start, end))
+            manifest = render_cache.put_render(etag, results['figures'], {'report': results['report']})
+            cached = manifest, results['figures']
+
+        manifest, figures = cached
+        return http_cache.with_etag(jsonify({
+            'visualizations': _figure_payload(etag, figures),
+            'report': manifest['report']
+        }), etag, last_modified)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+    except RenderPoolBusy:
+        return _render_busy()
+    except RenderTimeout:
+        return jsonify({"error": "Visualization timed out"}), 504
     except Exception as e:
         return jsonify({"error": f"Visualization failed: {str(e)}"}), 500
 
-def _figure_to_base64(fig):
-    """Convert matplotlib figure to base64 string"""
-    buf = io.BytesIO()
-    FigureCanvas(fig).print_png(buf)
-    return base64.b64encode(buf.getvalue()).decode('utf-8')
+def _too_few_dreams(minimum):
+    return jsonify({"error": f"At least {minimum} dreams are needed for visualizations"}), 422
+
+def _render_busy():
+    response = jsonify({"error": "Visualization service is busy, please retry shortly"})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def _window():
+    """The optional ?start=/&end= window of a visualization request"""
+    return parse_date(request.args.get('start'), 'start'), parse_date(request.args.get('end'), 'end')
+
+def render_version(view, user_id, start=None, end=None):
+    """ETag, Last-Modified and dream count for a rendered view of the user's current dream data"""
+    query = db_session.query(
+        func.count(DreamEntry.dream_id),
+        func.max(DreamEntry.timestamp)
+    ).filter(DreamEntry.user_id == user_id)
+    if start is not None:
+        query = query.filter(DreamEntry.timestamp >= start)
+    if end is not None:
+        query = query.filter(DreamEntry.timestamp < end)
+    count, last_modified = query.one()
+    # users.data_version changes with every write to the user's dreams, even
+    # when a delete and an insert leave the count and max(dream_id) as they were
+    key = make_key(view, user_id, start, end, http_cache.user_version(db_session, user_id))
+    return key, last_modified, count
+
+def _figure_payload(etag, figures):
+    """
+    Inline base64 PNGs, or URLs of the cached PNGs when ?format=url. Takes
+    the PNG bytes already read or rendered, so an eviction in between cannot
+    leave a figure missing.
+    """
+    if request.args.get('format') == 'url':
+        return {name: url_for('dreams.get_render', key=f'{etag}-{name}') for name in figures}
+    return {name: base64.b64encode(png).decode('utf-8') for name, png in figures.items()}
+
+@dream_bp.route("/dreams/renders/<key>.png", methods=['GET'])
+def get_render(key):
+    """Serve a cached PNG; keys are content addressed so it never changes"""
+    try:
+        png = render_cache.get(key)
+    except ValueError:
+        png = None
+    if png is None:
+        return jsonify({"error": "Render not found"}), 404
+    response = make_response(png)
+    response.mimetype = 'image/png'
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response.make_conditional(request)
 
 @dream_bp.route("/dreams/theme-visualization", methods=['GET'])
-def get_theme_visualization():
+@token_required
+def get_theme_visualization(current_user):
     try:
-        df, vectors = mood_analyzer.get_theme_visualization()
-        
-        # Convert the current figure to base64
-        theme_viz = _figure_to_base64(plt.gcf())
-        plt.close('all')
-        
-        return jsonify({
-            'visualization': theme_viz,
-            'theme_count': len(set(vectors.toarray().nonzero()[1]))
-        })
+        start, end = _window()
+        etag, last_modified, count = render_version('theme-visualization', current_user.user_id, start, end)
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag, last_modified)
+
+        cached = render_cache.get_render(etag)
+        if cached is None:
+            from dream_visualizer import MIN_DREAMS, render_theme_clusters
+            from mood_analyzer import dream_text_source
+            if count < MIN_DREAMS:
+                return _too_few_dreams(MIN_DREAMS)
+            results = render_pool.run(render_theme_clusters,
+                                      dream_text_source(current_user.user_id, start, end))
+            manifest = render_cache.put_render(etag, results['figures'], {
+                'theme_count': results['theme_count']
+            })
+            cached = manifest, results['figures']
+
+        manifest, figures = cached
+        payload = _figure_payload(etag, figures)
+        return http_cache.with_etag(jsonify({
+            'visualization': payload['visualization'],
+            'theme_count': manifest['theme_count']
+        }), etag, last_modified)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+    except RenderPoolBusy:
+        return _render_busy()
+    except RenderTimeout:
+        return jsonify({"error": "Theme visualization timed out"}), 504
     except Exception as e:
         return jsonify({"error": f"Theme visualization failed: {str(e)}"}), 500
 
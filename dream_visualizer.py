@@ -1,149 +1,273 @@
 import pandas as pd
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
+from sklearn.cluster import MiniBatchKMeans
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
+import io
+import os
 from datetime import datetime
 from collections import Counter
+from mood_aggregates import HOUR_COLUMNS, LABEL_COLUMNS
+import metrics
+
+# Theme clusters computed by DreamVisualizer; KMeans needs at least one dream per cluster
+N_CLUSTERS = 3
+MIN_DREAMS = N_CLUSTERS
+
+# Dreams sampled to fit the TF-IDF vocabulary and the clusters; the rest are
+# vectorized and assigned to clusters CHUNK_SIZE dreams at a time
+FIT_SAMPLE_SIZE = int(os.environ.get('VISUALIZER_SAMPLE_SIZE', 50000))
+CHUNK_SIZE = int(os.environ.get('VISUALIZER_CHUNK_SIZE', 10000))
+
+# Terms shown per cluster in the theme chart
+TOP_TERMS = 10
+
+class TooFewDreams(ValueError):
+    """Raised by DreamVisualizer.prepare_data when there are fewer than MIN_DREAMS dreams"""
+
+def _new_figure(figsize):
+    """
+    Figure bound to its own Agg canvas. Nothing goes through pyplot's global
+    figure registry, so concurrent renders cannot pick up each other's figures.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+def render_png(fig):
+    """Render a figure to PNG bytes"""
+    buf = io.BytesIO()
+    with metrics.timer('render'):
+        fig.canvas.print_png(buf)
+    return buf.getvalue()
 
 class DreamVisualizer:
-    def __init__(self):
+    def __init__(self, sample_size=FIT_SAMPLE_SIZE, chunksize=CHUNK_SIZE):
         self.vectorizer = TfidfVectorizer(
             stop_words='english',
             max_features=1000,
             ngram_range=(1, 2)
         )
-        self.kmeans = KMeans(n_clusters=3, random_state=42)
+        self.kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, random_state=42, n_init=3)
+        self.sample_size = sample_size
+        self.chunksize = chunksize
+        # Dreams containing each vocabulary term, filled by prepare_data
+        self.document_frequency = None
         
-    def prepare_data(self, dreams_df):
+    def prepare_data(self, dreams):
         """
-        Prepare dream data for visualization
+        Fit the theme clusters and assign every dream to one
         
         Parameters:
-        dreams_df: DataFrame containing dream entries with columns:
-            - dream_text: dream description
-            - mood: mood after dream
-            - created_at: timestamp of dream
+        dreams: DataFrame with a dream_text column, or a callable returning a
+            fresh iterable of such DataFrame chunks (see
+            mood_analyzer.dream_text_source); it is called twice
+
+        The first pass draws a seeded reservoir sample of at most sample_size
+        dreams, on which the vocabulary and clusters are fitted. The second
+        pass vectorizes and assigns clusters chunk by chunk, so only the
+        sample and one chunk are ever held in memory. Returns the cluster of
+        each dream in corpus order and the sparse TF-IDF matrix of the sample.
+        Raises TooFewDreams when there are fewer than MIN_DREAMS dreams.
         """
-        # Ensure datetime
-        df = dreams_df.copy()
-        df['created_at'] = pd.to_datetime(df['created_at'])
+        if isinstance(dreams, pd.DataFrame):
+            frame = dreams
+            dreams = lambda: (frame,)
+
+        sample, total = self._sample_texts(dreams())
+        if total < MIN_DREAMS:
+            raise TooFewDreams(f"At least {MIN_DREAMS} dreams are needed for visualizations")
         
         # Text vectorization and clustering
-        dream_vectors = self.vectorizer.fit_transform(df['dream_text'])
-        df['cluster'] = self.kmeans.fit_predict(dream_vectors)
+        with metrics.timer('tfidf'):
+            dream_vectors = self.vectorizer.fit_transform(sample)
+        with metrics.timer('kmeans'):
+            self.kmeans.fit(dream_vectors)
+        
+        clusters = []
+        self.document_frequency = np.zeros(dream_vectors.shape[1], dtype=np.int64)
+        for frame in dreams():
+            texts = frame['dream_text']
+            for start in range(0, len(texts), self.chunksize):
+                with metrics.timer('tfidf'):
+                    chunk = self.vectorizer.transform(texts.iloc[start:start + self.chunksize])
+                with metrics.timer('kmeans'):
+                    clusters.append(self.kmeans.predict(chunk).astype(np.int32))
+                self.document_frequency += chunk.getnnz(axis=0)
         
-        return df, dream_vectors
+        return np.concatenate(clusters), dream_vectors
+
+    def _sample_texts(self, frames):
+        """Seeded reservoir sample of at most sample_size texts in corpus order, and the corpus size"""
+        rng = np.random.default_rng(42)
+        texts = np.empty(self.sample_size, dtype=object)
+        positions = np.empty(self.sample_size, dtype=np.int64)
+        seen = 0
+        for frame in frames:
+            values = frame['dream_text'].to_numpy(dtype=object)
+            fill = min(len(values), max(self.sample_size - seen, 0))
+            texts[seen:seen + fill] = values[:fill]
+            positions[seen:seen + fill] = np.arange(seen, seen + fill)
+            if fill < len(values):
+                # Dream i replaces a random slot with probability sample_size / (i + 1)
+                indices = np.arange(seen + fill, seen + len(values))
+                slots = rng.integers(0, indices + 1)
+                for k in np.flatnonzero(slots < self.sample_size):
+                    texts[slots[k]] = values[fill + k]
+                    positions[slots[k]] = indices[k]
+            seen += len(values)
+        size = min(seen, self.sample_size)
+        order = np.argsort(positions[:size], kind='stable')
+        return texts[:size][order], seen
+
+    def theme_count(self):
+        """Distinct vocabulary terms occurring in the prepared dreams"""
+        return int(np.count_nonzero(self.document_frequency))
     
-    def plot_mood_calendar(self, df):
-        """Create a calendar heatmap of moods"""
-        plt.figure(figsize=(15, 8))
+    def plot_mood_calendar(self, daily):
+        """
+        Create a calendar heatmap of dream counts from the daily rollup
+        (one row per day, see mood_aggregates.daily_rollup)
+        """
+        fig = _new_figure((15, 8))
+        ax = fig.add_subplot()
         
         # Create pivot table for calendar
-        mood_pivot = df.pivot_table(
-            index=df['created_at'].dt.day_name(),
-            columns=df['created_at'].dt.month,
-            values='mood',
-            aggfunc='count'
+        days = pd.to_datetime(daily['day'])
+        mood_pivot = daily.pivot_table(
+            index=days.dt.day_name(),
+            columns=days.dt.month,
+            values='count',
+            aggfunc='sum'
         )
         
         # Plot heatmap
-        sns.heatmap(mood_pivot, cmap='YlOrRd', annot=True, fmt='g')
-        plt.title('Dream Mood Calendar Heatmap')
-        plt.xlabel('Month')
-        plt.ylabel('Day of Week')
-        plt.tight_layout()
+        sns.heatmap(mood_pivot, cmap='YlOrRd', annot=True, fmt='g', ax=ax)
+        ax.set_title('Dream Mood Calendar Heatmap')
+        ax.set_xlabel('Month')
+        ax.set_ylabel('Day of Week')
+        fig.tight_layout()
+        return fig
         
-    def plot_mood_distribution(self, df):
-        """Plot distribution of moods over time"""
-        plt.figure(figsize=(12, 6))
+    def plot_mood_distribution(self, daily):
+        """Plot distribution of moods over time from the daily rollup"""
+        fig = _new_figure((12, 6))
+        ax = fig.add_subplot()
         
-        # Group by week and mood
-        weekly_moods = df.groupby([
-            pd.Grouper(key='created_at', freq='W'),
-            'mood'
-        ]).size().unstack().fillna(0)
+        # Sum the daily mood label counts per week
+        weekly_moods = daily.set_index(pd.to_datetime(daily['day']))[
+            list(LABEL_COLUMNS.values())
+        ].resample('W').sum()
+        weekly_moods.columns = list(LABEL_COLUMNS)
+        weekly_moods = weekly_moods.loc[:, (weekly_moods > 0).any()]
         
         # Create stacked bar plot
-        weekly_moods.plot(kind='bar', stacked=True)
-        plt.title('Weekly Mood Distribution')
-        plt.xlabel('Week')
-        plt.ylabel('Number of Dreams')
-        plt.legend(title='Mood')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
+        weekly_moods.plot(kind='bar', stacked=True, ax=ax)
+        ax.set_title('Weekly Mood Distribution')
+        ax.set_xlabel('Week')
+        ax.set_ylabel('Number of Dreams')
+        ax.legend(title='Mood')
+        ax.tick_params(axis='x', labelrotation=45)
+        fig.tight_layout()
+        return fig
     
     def plot_theme_clusters(self, dream_vectors):
         """Visualize dream themes using cluster analysis"""
         feature_names = self.vectorizer.get_feature_names_out()
         cluster_centers = self.kmeans.cluster_centers_
         
-        plt.figure(figsize=(15, 5))
+        fig = _new_figure((15, 5))
         for idx, center in enumerate(cluster_centers):
-            plt.subplot(1, 3, idx + 1)
+            ax = fig.add_subplot(1, 3, idx + 1)
             
-            # Get top terms
-            top_indices = center.argsort()[-10:][::-1]
+            # Get top terms: partial selection, then sort only those
+            k = min(TOP_TERMS, len(center))
+            top_indices = np.argpartition(center, -k)[-k:]
+            top_indices = top_indices[np.argsort(center[top_indices])[::-1]]
             top_terms = [feature_names[i] for i in top_indices]
             top_weights = center[top_indices]
             
             # Create horizontal bar plot
-            plt.barh(range(len(top_terms)), top_weights)
-            plt.yticks(range(len(top_terms)), top_terms)
-            plt.title(f'Cluster {idx} Themes')
+            ax.barh(range(len(top_terms)), top_weights)
+            ax.set_yticks(range(len(top_terms)))
+            ax.set_yticklabels(top_terms)
+            ax.set_title(f'Cluster {idx} Themes')
             
-        plt.tight_layout()
+        fig.tight_layout()
+        return fig
     
-    def generate_report(self, df):
-        """Generate a statistical report of dream patterns"""
+    def generate_report(self, daily):
+        """Generate a statistical report of dream patterns from the daily rollup"""
         report = []
+        total = daily['count'].sum()
         
         # Mood statistics
-        mood_stats = df['mood'].value_counts()
+        mood_stats = pd.Series({
+            label: daily[column].sum() for label, column in LABEL_COLUMNS.items()
+        }).sort_values(ascending=False, kind='stable')
         report.append("Mood Distribution:")
-        for mood, count in mood_stats.items():
-            report.append(f"- {mood}: {count} dreams ({count/len(df)*100:.1f}%)")
+        for mood, count in mood_stats[mood_stats > 0].items():
+            report.append(f"- {mood}: {count} dreams ({count/total*100:.1f}%)")
             
         # Time patterns
-        time_patterns = df.groupby(df['created_at'].dt.hour)['mood'].value_counts()
+        hour_counts = pd.Series([daily[column].sum() for column in HOUR_COLUMNS])
         report.append("\nPeak Dream Recording Times:")
-        peak_hours = time_patterns.groupby(level=0).sum().nlargest(3)
+        peak_hours = hour_counts[hour_counts > 0].nlargest(3)
         for hour, count in peak_hours.items():
             report.append(f"- {hour:02d}:00: {count} dreams")
             
         return "\n".join(report)
 
+def render_mood_patterns(dreams, daily):
+    """
+    Render-pool job: mood calendar, weekly distribution and theme clusters as
+    PNG bytes, plus the text report. The calendar, distribution and report
+    read the daily rollup; only the theme clusters need the dream texts,
+    which the job streams from `dreams` (see DreamVisualizer.prepare_data).
+    """
+    visualizer = DreamVisualizer()
+    clusters, vectors = visualizer.prepare_data(dreams)
+    figures = [
+        visualizer.plot_mood_calendar(daily),
+        visualizer.plot_mood_distribution(daily),
+        visualizer.plot_theme_clusters(vectors)
+    ]
+    return {
+        'figures': {f'figure_{i + 1}': render_png(fig) for i, fig in enumerate(figures)},
+        'report': visualizer.generate_report(daily)
+    }
+
+def render_theme_clusters(dreams):
+    """Render-pool job: theme cluster chart as PNG bytes plus the distinct term count"""
+    visualizer = DreamVisualizer()
+    clusters, vectors = visualizer.prepare_data(dreams)
+    fig = visualizer.plot_theme_clusters(vectors)
+    return {
+        'figures': {'visualization': render_png(fig)},
+        'theme_count': visualizer.theme_count()
+    }
+
 def main():
     # Example usage (commented out as you'll integrate with your existing data)
     """
-    from models import Dream  # Import your Dream model
-    from sqlalchemy.orm import Session
-    from database import SessionLocal
-    
-    # Get dreams from database
-    db = SessionLocal()
-    dreams = db.query(Dream).all()
+    from mood_analyzer import MoodAnalyzer, dream_text_source
     
-    # Convert to DataFrame
-    dreams_df = pd.DataFrame([
-        {
-            'dream_text': dream.content,
-            'mood': dream.mood,
-            'created_at': dream.created_at
-        } for dream in dreams
-    ])
+    # Stream one user's dreams and load their daily mood rollup from the database
+    analyzer = MoodAnalyzer()
+    daily = analyzer.load_daily_frame(user_id=1)
     
     visualizer = DreamVisualizer()
-    df, vectors = visualizer.prepare_data(dreams_df)
+    clusters, vectors = visualizer.prepare_data(dream_text_source(user_id=1))
     
     # Generate visualizations
-    visualizer.plot_mood_calendar(df)
-    visualizer.plot_mood_distribution(df)
+    visualizer.plot_mood_calendar(daily)
+    visualizer.plot_mood_distribution(daily)
     visualizer.plot_theme_clusters(vectors)
     
     # Generate report
-    print(visualizer.generate_report(df))
+    print(visualizer.generate_report(daily))
     """
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from models import DreamEntry, read_db_session
+from auth_middleware import token_required
+import csv
+import io
+import json
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+export_bp = Blueprint('export', __name__)
+
+# Rows fetched from the database cursor per round trip
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = ('dream_id', 'dream_text', 'mood_score', 'timestamp')
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+@export_bp.route('/export_dreams', methods=['GET'])
+@token_required
+def export_dreams(current_user):
+    """
+    Stream the user's complete dream history as NDJSON (default) or CSV.
+    Output is gzip-compressed on the fly when the client accepts it.
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'message': 'format must be ndjson or csv'}), 400
+
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    lines = _iter_export(current_user.user_id, export_format)
+    body = _gzip_stream(lines) if use_gzip else (line.encode('utf-8') for line in lines)
+
+    response = Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename=dreams.{export_format}'
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    logger.info(f"Started {export_format} export for user: {current_user.username}")
+    return response
+
+
+def _iter_rows(user_id):
+    """Yield the user's dreams oldest first, fetched in fixed-size chunks"""
+    query = read_db_session.query(
+        DreamEntry.dream_id,
+        DreamEntry.dream_text,
+        DreamEntry.mood_score,
+        DreamEntry.timestamp
+    ).filter(
+        DreamEntry.user_id == user_id
+    ).order_by(
+        DreamEntry.timestamp, DreamEntry.dream_id
+    ).execution_options(stream_results=True).yield_per(EXPORT_CHUNK_SIZE)
+
+    for row in query:
+        yield {
+            'dream_id': row.dream_id,
+            'dream_text': row.dream_text,
+            'mood_score': row.mood_score,
+            'timestamp': row.timestamp.isoformat() if row.timestamp else None
+        }
+
+
+def _iter_export(user_id, export_format):
+    """Serialize rows to text, one chunk of output per EXPORT_CHUNK_SIZE rows"""
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: buffer.write(json.dumps(row) + '\n')
+
+    pending = 0
+    for row in _iter_rows(user_id):
+        write(row)
+        pending += 1
+        if pending >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _gzip_stream(chunks):
+    """Compress a stream of text chunks into a single gzip member"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
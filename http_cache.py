@@ -0,0 +1,103 @@
+"""
+Conditional GET and gzip for the JSON read endpoints.
+
+Every user has a data version (users.data_version) bumped in the same
+transaction as any change to their dreams. Read endpoints derive a strong
+ETag from it, so a matching If-None-Match is answered with 304 after one
+primary-key lookup, before any query or analysis work. init_app gzips JSON
+responses of at least GZIP_MIN_BYTES for clients that accept it.
+"""
+import gzip
+import hashlib
+import logging
+import os
+from flask import make_response, request
+from sqlalchemy import func, update
+from models import DreamEntry, User
+
+logger = logging.getLogger(__name__)
+
+# JSON responses smaller than this are sent uncompressed
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+
+# Appended to the ETag of gzip-encoded responses, which are a different representation
+GZIP_ETAG_SUFFIX = '-gzip'
+
+
+def bump_version(session, user_id):
+    """Mark the user's data changed; the caller commits with the change itself"""
+    table = User.__table__
+    session.execute(update(table).where(table.c.user_id == user_id).values(
+        data_version=func.coalesce(table.c.data_version, 0) + 1
+    ))
+
+
+def user_version(session, user_id):
+    return session.query(func.coalesce(User.data_version, 0)).filter(
+        User.user_id == user_id
+    ).scalar()
+
+
+def dream_version(session, dream_id):
+    """(owner user_id, owner data version) of a dream, or None if it does not exist"""
+    row = session.query(
+        DreamEntry.user_id, func.coalesce(User.data_version, 0)
+    ).join(User, User.user_id == DreamEntry.user_id).filter(
+        DreamEntry.dream_id == dream_id
+    ).first()
+    return tuple(row) if row is not None else None
+
+
+def make_etag(*parts):
+    text = ':'.join(str(part) for part in parts)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+def is_fresh(etag):
+    """Whether the request's If-None-Match already names this ETag, in either encoding"""
+    return request.if_none_match.contains(etag) or \
+        request.if_none_match.contains(etag + GZIP_ETAG_SUFFIX)
+
+
+def not_modified(etag, last_modified=None):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def with_etag(response, etag, last_modified=None):
+    """Tag a 200 JSON response so the client can revalidate it"""
+    response = make_response(response)
+    if response.status_code == 200:
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def init_app(app):
+    """gzip-compress large JSON responses for clients that accept it"""
+
+    @app.after_request
+    def _gzip_response(response):
+        if response.direct_passthrough or response.is_streamed or \
+                response.status_code != 200 or response.mimetype != 'application/json' or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        if 'gzip' not in request.headers.get('Accept-Encoding', '') or \
+                response.calculate_content_length() < GZIP_MIN_BYTES:
+            return response
+
+        response.set_data(gzip.compress(response.get_data(), compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag + GZIP_ETAG_SUFFIX)
+        return response
@@ -0,0 +1,113 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+from flask import jsonify, make_response, request
+from sqlalchemy import and_, or_
+from models import IdempotencyRecord
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+MAX_KEY_LENGTH = 255
+
+# How long a key is remembered; a retry after this runs the request again
+IDEMPOTENCY_TTL = datetime.timedelta(hours=int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24)))
+
+# Seconds between purges of expired records by each process
+PURGE_INTERVAL = int(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 300))
+
+# time.monotonic() of this process's last purge
+_last_purge = None
+
+
+class IdempotencyError(ValueError):
+    """Raised for a malformed Idempotency-Key header"""
+
+
+def request_key():
+    """The Idempotency-Key of the current request, or None if it has none"""
+    key = request.headers.get(IDEMPOTENCY_HEADER, '').strip()
+    if not key:
+        return None
+    if len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f'{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters')
+    return key
+
+
+def request_hasher():
+    """SHA-256 seeded with the request path and query; feed it the body"""
+    return hashlib.sha256(request.full_path.encode('utf-8') + b'\n')
+
+
+def request_hash(body):
+    hasher = request_hasher()
+    hasher.update(body)
+    return hasher.hexdigest()
+
+
+def find(session, user_id, key):
+    """The unexpired record stored under the key, or None"""
+    record = session.get(IdempotencyRecord, (user_id, key))
+    if record is None or _expired(record):
+        return None
+    return record
+
+
+def replay(record, req_hash):
+    """The stored response, or 422 if the key was used for a different request"""
+    if record.request_hash != req_hash:
+        return jsonify({
+            'message': f'{IDEMPOTENCY_HEADER} was already used for a different request'
+        }), 422
+    response = make_response(record.response_body, record.status_code)
+    response.mimetype = 'application/json'
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def remember(session, user_id, key, req_hash, status_code, payload):
+    """
+    Store the response in the caller's transaction. A concurrent request with
+    the same key makes the commit fail with an IntegrityError; the loser
+    rolls back and replays the winner's response. At most every
+    PURGE_INTERVAL seconds the write also deletes every expired record.
+    """
+    now = datetime.datetime.utcnow()
+    session.query(IdempotencyRecord).filter(
+        IdempotencyRecord.user_id == user_id,
+        IdempotencyRecord.key == key,
+        _expired_clause(now)
+    ).delete(synchronize_session=False)
+    _purge_expired(session, now)
+    session.add(IdempotencyRecord(
+        user_id=user_id,
+        key=key,
+        request_hash=req_hash,
+        status_code=status_code,
+        response_body=json.dumps(payload),
+        created_at=now,
+        expires_at=now + IDEMPOTENCY_TTL
+    ))
+
+
+def _purge_expired(session, now):
+    global _last_purge
+    if _last_purge is not None and time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    session.query(IdempotencyRecord).filter(_expired_clause(now)).delete(synchronize_session=False)
+
+
+def _expired(record):
+    if record.expires_at is not None:
+        return record.expires_at < datetime.datetime.utcnow()
+    return record.created_at < datetime.datetime.utcnow() - IDEMPOTENCY_TTL
+
+
+def _expired_clause(now):
+    # Records stored before expires_at existed expire by created_at
+    return or_(
+        IdempotencyRecord.expires_at < now,
+        and_(IdempotencyRecord.expires_at.is_(None), IdempotencyRecord.created_at < now - IDEMPOTENCY_TTL)
+    )
@@ -0,0 +1,331 @@
+from flask import Blueprint, jsonify, request
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from models import DreamEntry, db_session
+from auth_middleware import token_required
+import csv
+import datetime
+import io
+import json
+import logging
+import math
+import os
+import re
+import http_cache
+import idempotency
+import mood_aggregates
+
+logger = logging.getLogger(__name__)
+
+import_bp = Blueprint('import', __name__)
+
+# Rows inserted per executemany round trip
+IMPORT_BATCH_SIZE = 500
+
+# Larger imports are rejected; split them into several requests
+MAX_IMPORT_ROWS = int(os.environ.get('MAX_IMPORT_ROWS', 50000))
+
+# Processes used to score the import (1 scores in the request thread)
+IMPORT_SCORE_WORKERS = int(os.environ.get('IMPORT_SCORE_WORKERS', 1))
+
+# Per-row errors listed in the response; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+# Characters read from the body at a time
+READ_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Stands in for an NDJSON line that does not parse
+_INVALID_JSON = object()
+
+IMPORT_FORMATS = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'text/csv': 'csv'
+}
+
+
+class ImportFormatError(ValueError):
+    """The body cannot be parsed any further; the whole import is rejected"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RowError(ValueError):
+    """A single row is invalid; it is skipped and reported"""
+
+
+@import_bp.route('/import_dreams', methods=['POST'])
+@token_required
+def import_dreams(current_user):
+    """
+    Bulk-import dreams from a JSON array, NDJSON or CSV body, read as a stream.
+    Each row has dream_text and optionally mood_score and an ISO 8601
+    timestamp. Invalid rows are skipped and reported; valid rows are scored
+    first and then inserted in one short transaction, so the database is not
+    locked while scoring. Pass score=0 to skip server-side sentiment scoring.
+    """
+    import_format = request.args.get('format') or \
+        IMPORT_FORMATS.get(request.mimetype) or 'json'
+    if import_format not in IMPORT_FORMATS.values():
+        return jsonify({'message': 'format must be json, ndjson or csv'}), 400
+    score = request.args.get('score', '1') != '0'
+
+    try:
+        key = idempotency.request_key()
+    except idempotency.IdempotencyError as e:
+        return jsonify({'message': str(e)}), 400
+
+    body = _HashingStream(request.stream, idempotency.request_hasher())
+    if key:
+        record = idempotency.find(db_session, current_user.user_id, key)
+        if record is not None:
+            while body.read(READ_SIZE):
+                pass
+            return idempotency.replay(record, body.hasher.hexdigest())
+
+    reader = io.TextIOWrapper(io.BufferedReader(body), encoding='utf-8', newline='')
+    try:
+        payload = _import_rows(current_user.user_id, _iter_rows(reader, import_format), score)
+        if key:
+            idempotency.remember(db_session, current_user.user_id, key,
+                                 body.hasher.hexdigest(), 200, payload)
+        db_session.commit()
+        logger.info(f"Imported {payload['imported']} dreams for user: {current_user.username}")
+        return jsonify(payload), 200
+
+    except ImportFormatError as e:
+        db_session.rollback()
+        return jsonify({'message': str(e)}), e.status_code
+    except UnicodeDecodeError:
+        db_session.rollback()
+        return jsonify({'message': 'Body must be UTF-8 encoded'}), 400
+    except IntegrityError as e:
+        db_session.rollback()
+        record = idempotency.find(db_session, current_user.user_id, key) if key else None
+        if record is not None:
+            return idempotency.replay(record, body.hasher.hexdigest())
+        logger.error(f"Database error while importing dreams: {str(e)}")
+        return jsonify({'message': 'Database error occurred'}), 500
+    except SQLAlchemyError as e:
+        db_session.rollback()
+        logger.error(f"Database error while importing dreams: {str(e)}")
+        return jsonify({'message': 'Database error occurred'}), 500
+    except Exception as e:
+        db_session.rollback()
+        logger.error(f"Error importing dreams: {str(e)}")
+        return jsonify({'message': 'An error occurred while importing dreams'}), 500
+
+
+def _import_rows(user_id, rows, score):
+    """Validate and score every row, then insert them batch by batch; returns the response payload"""
+    failed = 0
+    errors = []
+    valid = []
+
+    for row_number, raw in enumerate(rows, start=1):
+        if row_number > MAX_IMPORT_ROWS:
+            raise ImportFormatError(f'Imports are limited to {MAX_IMPORT_ROWS} rows', 413)
+        try:
+            valid.append(_validate_row(raw, user_id))
+        except RowError as e:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'row': row_number, 'message': str(e)})
+
+    # Scored before the first insert, which is what takes the SQLite write lock
+    if score and valid:
+        _score_rows(valid)
+
+    imported = 0
+    for i in range(0, len(valid), IMPORT_BATCH_SIZE):
+        imported += _insert_batch(valid[i:i + IMPORT_BATCH_SIZE])
+
+    # Imported rows can land anywhere in the user's history
+    if imported:
+        mood_aggregates.rebuild_user(db_session, user_id)
+        http_cache.bump_version(db_session, user_id)
+
+    return {
+        'message': f'Imported {imported} dreams',
+        'imported': imported,
+        'failed': failed,
+        'errors': errors,
+        'errors_truncated': failed > len(errors)
+    }
+
+
+def _score_rows(rows):
+    """Fill in the analysis columns of every row with one analyze_batch call"""
+    # Imported here so importing the app does not load the analyzer's dependencies
+    from dream_routes import get_mood_analyzer
+    from mood_analyzer import SCORE_COMPONENTS
+    mood_analyzer = get_mood_analyzer()
+    scores = mood_analyzer.analyze_batch(
+        [row['dream_text'] for row in rows], workers=IMPORT_SCORE_WORKERS
+    )
+    offsets = scores['theme_offsets']
+    for i, row in enumerate(rows):
+        for name in SCORE_COMPONENTS:
+            row[name] = float(scores[name][i])
+        theme_ids = scores['theme_ids'][offsets[i]:offsets[i + 1]]
+        row['detected_themes'] = json.dumps([scores['theme_names'][j] for j in theme_ids])
+        row['analysis_version'] = mood_analyzer.lexicon_version
+        if row['mood_score'] is None:
+            row['mood_score'] = row['combined_score']
+
+
+def _insert_batch(rows):
+    """Insert one batch with a single executemany"""
+    db_session.execute(insert(DreamEntry.__table__), rows)
+    return len(rows)
+
+
+def _validate_row(raw, user_id):
+    """Turn one parsed row into column values, or raise RowError"""
+    if raw is _INVALID_JSON:
+        raise RowError('Row is not valid JSON')
+    if not isinstance(raw, dict):
+        raise RowError('Row must be an object')
+
+    dream_text = raw.get('dream_text')
+    if not isinstance(dream_text, str) or not dream_text.strip():
+        raise RowError('dream_text is required')
+
+    mood_score = raw.get('mood_score')
+    if mood_score in (None, ''):
+        mood_score = None
+    else:
+        try:
+            mood_score = float(mood_score)
+        except (TypeError, ValueError):
+            raise RowError('mood_score must be a number')
+        if isinstance(raw.get('mood_score'), bool) or not math.isfinite(mood_score) \
+                or not -1.0 <= mood_score <= 1.0:
+            raise RowError('mood_score must be between -1 and 1')
+
+    return {
+        'user_id': user_id,
+        'dream_text': dream_text,
+        'mood_score': mood_score,
+        'timestamp': _parse_timestamp(raw.get('timestamp'))
+    }
+
+
+def _parse_timestamp(value):
+    """ISO 8601 timestamp as naive UTC, like DreamEntry's default; now if missing"""
+    if value in (None, ''):
+        return datetime.datetime.utcnow()
+    if not isinstance(value, str):
+        raise RowError('timestamp must be an ISO 8601 string')
+    try:
+        timestamp = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise RowError('timestamp must be an ISO 8601 string')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _iter_rows(reader, import_format):
+    if import_format == 'csv':
+        return _iter_csv(reader)
+    if import_format == 'ndjson':
+        return _iter_ndjson(reader)
+    return _iter_json_array(reader)
+
+
+def _iter_csv(reader):
+    rows = csv.DictReader(reader)
+    if rows.fieldnames is None or 'dream_text' not in rows.fieldnames:
+        raise ImportFormatError('CSV header must include dream_text')
+    try:
+        yield from rows
+    except csv.Error as e:
+        raise ImportFormatError(f'Malformed CSV at line {rows.line_num}: {e}')
+
+
+def _iter_ndjson(reader):
+    """One JSON object per line; a malformed line is a row error"""
+    for line in reader:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield _INVALID_JSON
+
+
+def _iter_json_array(reader):
+    """Yield the elements of a top-level JSON array without loading it whole"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    expect = '['  # then 'first' (value or ']'), 'value', 'separator' (',' or ']'), 'done'
+
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                if expect == 'done':
+                    return
+                raise ImportFormatError('Unexpected end of JSON array')
+            buffer, pos, eof = _read_more(reader, buffer, pos)
+            continue
+
+        char = buffer[pos]
+        if expect == 'done':
+            raise ImportFormatError('Unexpected data after JSON array')
+        if expect == '[':
+            if char != '[':
+                raise ImportFormatError('Body must be a JSON array')
+            pos += 1
+            expect = 'first'
+        elif expect == 'separator' or (expect == 'first' and char == ']'):
+            if char not in ',]':
+                raise ImportFormatError("Expected ',' or ']' in JSON array")
+            pos += 1
+            expect = 'value' if char == ',' else 'done'
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except ValueError as e:
+                if eof:
+                    raise ImportFormatError(f'Malformed JSON: {e.msg}')
+                buffer, pos, eof = _read_more(reader, buffer, pos)
+                continue
+            if end == len(buffer) and not eof:
+                # A number at the end of the buffer may continue in the next chunk
+                buffer, pos, eof = _read_more(reader, buffer, pos)
+                continue
+            yield value
+            pos = end
+            expect = 'separator'
+
+
+def _read_more(reader, buffer, pos):
+    """Drop the consumed part of the buffer and append the next chunk"""
+    chunk = reader.read(READ_SIZE)
+    return buffer[pos:] + chunk, 0, not chunk
+
+
+class _HashingStream(io.RawIOBase):
+    """Readable wrapper that feeds everything read through a hash"""
+
+    def __init__(self, stream, hasher):
+        self.stream = stream
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.hasher.update(data)
+        buffer[:len(data)] = data
+        return len(data)
@@ -0,0 +1,112 @@
+from flask import Blueprint, jsonify, request, url_for
+from auth_middleware import token_required
+from dream_routes import render_version
+from jobs import JOB_KINDS, JobQueueFull, job_runner, job_store
+from pagination import PaginationError, parse_date
+import logging
+import mood_aggregates
+
+logger = logging.getLogger(__name__)
+
+job_bp = Blueprint('jobs', __name__)
+
+# Longest a GET /jobs/<id>?wait= request may block; kept short because the
+# request holds a server worker while it polls
+MAX_WAIT_SECONDS = 2
+
+# Job kinds that render figures, and the render view each one caches
+RENDER_VIEWS = {
+    'visualizations': 'visualizations',
+    'theme-visualization': 'theme-visualization'
+}
+
+
+@job_bp.route('/jobs', methods=['POST'])
+@token_required
+def submit_job(current_user):
+    """
+    Start an analysis job in the background: JSON body with `kind` (insights,
+    visualizations or theme-visualization) and, for the visualizations, an
+    optional start/end window. Returns 202 with the job id at once.
+    """
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    if kind not in JOB_KINDS:
+        return jsonify({'message': f"kind must be one of: {', '.join(JOB_KINDS)}"}), 400
+
+    try:
+        params = {}
+        if kind in RENDER_VIEWS:
+            start = parse_date(data.get('start'), 'start')
+            end = parse_date(data.get('end'), 'end')
+            if kind == 'visualizations':
+                # Same whole-day window as GET /dreams/visualizations
+                start, end = mood_aggregates.day_window(start, end)
+            # The render key names the data version, so identical data shares one job
+            key, _, _ = render_version(RENDER_VIEWS[kind], current_user.user_id, start, end)
+            params = {
+                'start': start.isoformat() if start else None,
+                'end': end.isoformat() if end else None,
+                'key': key
+            }
+        job, created = job_runner.submit(current_user.user_id, kind, params)
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+    except JobQueueFull:
+        response = jsonify({'message': 'Job queue is full, please retry shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except Exception as e:
+        logger.error(f"Error submitting {kind} job: {str(e)}")
+        return jsonify({'message': f'Error submitting job: {str(e)}'}), 500
+
+    status_url = url_for('jobs.get_job', job_id=job['job_id'])
+    response = jsonify(dict(_job_payload(job), status_url=status_url, deduplicated=not created))
+    response.headers['Location'] = status_url
+    return response, 202
+
+
+@job_bp.route('/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_job(current_user, job_id):
+    """
+    Status of a job, with its result once done. Pass ?wait=<seconds> (at most
+    2) to wait briefly for the job to finish.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_WAIT_SECONDS)
+    except ValueError:
+        return jsonify({'message': 'wait must be a number of seconds'}), 400
+
+    job = job_store.wait(job_id, wait) if wait > 0 else job_store.get(job_id)
+    if job is None or job['user_id'] != current_user.user_id:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(_job_payload(job))
+
+
+def _job_payload(job):
+    payload = {
+        'job_id': job['job_id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at']
+    }
+    if job['status'] == 'done':
+        payload['result'] = _present_result(job['kind'], job['result'])
+    elif job['status'] == 'failed':
+        payload['error'] = job['error']
+    return payload
+
+
+def _present_result(kind, result):
+    """Render job results carry figure names; clients get the PNG URLs"""
+    if kind not in RENDER_VIEWS:
+        return result
+    urls = {
+        name: url_for('dreams.get_render', key=f"{result['key']}-{name}")
+        for name in result['figures']
+    }
+    if kind == 'theme-visualization':
+        return {'visualization': urls['visualization'], 'theme_count': result['theme_count']}
+    return {'visualizations': urls, 'report': result['report']}
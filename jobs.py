@@ -0,0 +1,422 @@
+"""
+Asynchronous analysis jobs.
+
+Submitting a job returns its id at once. A bounded local process pool runs
+the MoodInsights and DreamVisualizer work and records the outcome in a
+SQLite result store (JOB_STORE_PATH) shared by every process on the host,
+so any gunicorn worker can answer a poll. Finished jobs are kept for
+JOB_RESULT_TTL seconds. Submitting a job identical to one the same user
+still has queued or running returns the existing job instead of starting
+another.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_STORE_PATH = os.environ.get(
+    'JOB_STORE_PATH', os.path.join(tempfile.gettempdir(), 'dream_journal_jobs.db')
+)
+
+# Seconds a finished job's result stays available
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))
+
+ACTIVE_STATES = ('queued', 'running')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    dedupe_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    deadline REAL NOT NULL,
+    expires_at REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_active_dedupe
+    ON jobs (dedupe_key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS ix_jobs_expires_at ON jobs (expires_at);
+"""
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue is full; the caller should retry later"""
+
+
+class JobError(Exception):
+    """Raised by a job for an expected failure; the message is shown to the client"""
+
+
+class JobTimeout(Exception):
+    """Raised inside a worker when a job exceeds its time limit"""
+
+
+def dedupe_key(user_id, kind, params):
+    """Jobs with the same key do the same work"""
+    text = json.dumps([user_id, kind, params], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class JobStore:
+    """Job states and results in a SQLite file, safe to share between processes"""
+
+    def __init__(self, path=JOB_STORE_PATH, ttl=JOB_RESULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._ready = True
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            # Take the write lock up front so check-then-insert cannot race
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _expire(self, conn, now):
+        # Jobs whose worker died never finish; fail them so they stop deduplicating
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Job timed out', finished_at = ?, expires_at = ? "
+            "WHERE status IN ('queued', 'running') AND deadline < ?",
+            (now, now + self.ttl, now)
+        )
+        conn.execute('DELETE FROM jobs WHERE expires_at < ?', (now,))
+
+    def create(self, user_id, kind, params, deadline):
+        """Queue a job unless an identical one is active; returns (job, created)"""
+        now = time.time()
+        key = dedupe_key(user_id, kind, params)
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running')", (key,)
+            ).fetchone()
+            if row is not None:
+                return _job(row), False
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                'INSERT INTO jobs (job_id, user_id, kind, params, dedupe_key, status, created_at, deadline) '
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, user_id, kind, json.dumps(params), key, now, deadline)
+            )
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return _job(row), True
+
+    def find_active(self, user_id, kind, params):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running') AND deadline >= ?",
+                (dedupe_key(user_id, kind, params), time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+        return _job(row) if row is not None else None
+
+    def get(self, job_id):
+        """
+        The job, or None if it is unknown or its result has expired. Read-only,
+        so polling never takes the write lock; create() does the expiry writes.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None or (row['expires_at'] is not None and row['expires_at'] < now):
+            return None
+        job = _job(row)
+        if job['status'] in ACTIVE_STATES and row['deadline'] < now:
+            # Its worker died; report the failure the next _expire will record
+            job.update(status='failed', error='Job timed out', finished_at=_isoformat(row['deadline']))
+        return job
+
+    def wait(self, job_id, timeout, interval=0.2):
+        """Poll until the job finishes or `timeout` seconds pass; returns its latest state"""
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        while job is not None and job['status'] in ACTIVE_STATES and time.monotonic() < deadline:
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            job = self.get(job_id)
+        return job
+
+    def mark_running(self, job_id):
+        """Claim a queued job; False if it is no longer queued"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ? WHERE job_id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id, result):
+        self._finish(job_id, 'done', result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._finish(job_id, 'failed', error=error)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, expires_at = ? '
+                "WHERE job_id = ? AND status IN ('queued', 'running')",
+                (status, result, error, now, now + self.ttl, job_id)
+            )
+
+
+def _job(row):
+    return {
+        'job_id': row['job_id'],
+        'user_id': row['user_id'],
+        'kind': row['kind'],
+        'params': json.loads(row['params']),
+        'status': row['status'],
+        'result': json.loads(row['result']) if row['result'] is not None else None,
+        'error': row['error'],
+        'created_at': _isoformat(row['created_at']),
+        'finished_at': _isoformat(row['finished_at'])
+    }
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat()
+
+
+# Job kinds: each takes (user_id, params) and returns a JSON-serializable result.
+# They run inside pool workers and import the heavy modules there.
+
+_worker_analyzer = None
+
+
+def _analyzer():
+    """MoodAnalyzer of this worker process, loaded once"""
+    global _worker_analyzer
+    if _worker_analyzer is None:
+        from mood_analyzer import MoodAnalyzer
+        _worker_analyzer = MoodAnalyzer()
+    return _worker_analyzer
+
+
+def _window(params):
+    return tuple(
+        datetime.datetime.fromisoformat(params[name]) if params.get(name) else None
+        for name in ('start', 'end')
+    )
+
+
+def run_insights(user_id, params):
+    from models import db_session, read_db_session
+    from mood_insights import MoodInsights
+    try:
+        insights = MoodInsights(user_id)
+        return {
+            'mood_trends': insights.get_mood_trends(),
+            'themes': insights.find_recurring_themes(),
+            'feedback': insights.generate_feedback()
+        }
+    finally:
+        db_session.remove()
+        read_db_session.remove()
+
+
+def run_visualizations(user_id, params):
+    """Mood pattern figures, cached in the render cache under params['key']"""
+    from dream_visualizer import TooFewDreams, render_mood_patterns
+    from mood_analyzer import dream_text_source
+    from render_cache import render_cache
+    manifest = render_cache.get_manifest(params['key'])
+    if manifest is None:
+        start, end = _window(params)
+        try:
+            results = render_mood_patterns(dream_text_source(user_id, start, end),
+                                           _analyzer().load_daily_frame(user_id, start, end))
+        except TooFewDreams as e:
+            raise JobError(str(e))
+        manifest = render_cache.put_render(params['key'], results['figures'], {'report': results['report']})
+    return dict(manifest, key=params['key'])
+
+
+def run_theme_visualization(user_id, params):
+    """Theme cluster figure, cached in the render cache under params['key']"""
+    from dream_visualizer import TooFewDreams, render_theme_clusters
+    from mood_analyzer import dream_text_source
+    from render_cache import render_cache
+    manifest = render_cache.get_manifest(params['key'])
+    if manifest is None:
+        start, end = _window(params)
+        try:
+            results = render_theme_clusters(dream_text_source(user_id, start, end))
+        except TooFewDreams as e:
+            raise JobError(str(e))
+        manifest = render_cache.put_render(params['key'], results['figures'], {
+            'theme_count': results['theme_count']
+        })
+    return dict(manifest, key=params['key'])
+
+
+JOB_KINDS = {
+    'insights': run_insights,
+    'visualizations': run_visualizations,
+    'theme-visualization': run_theme_visualization
+}
+
+
+def _alarm_handler(signum, frame):
+    raise JobTimeout('Job timed out')
+
+
+def _execute(store_path, job_id, kind, user_id, params, timeout):
+    """Run one job inside a pool worker and record its outcome"""
+    store = JobStore(store_path)
+    if not store.mark_running(job_id):
+        return
+    signal.signal(signal.SIGALRM, _alarm_handler)
+    signal.alarm(timeout)
+    try:
+        try:
+            with metrics.timer(f'job_{kind}'):
+                result = JOB_KINDS[kind](user_id, params)
+        finally:
+            signal.alarm(0)
+    except (JobError, JobTimeout) as e:
+        store.fail(job_id, str(e))
+    except Exception as e:
+        logger.exception(f"Job {job_id} ({kind}) failed")
+        store.fail(job_id, f'Job failed: {e}')
+    else:
+        store.finish(job_id, result)
+    finally:
+        # Workers exit without running atexit handlers
+        metrics.registry.flush()
+
+
+class JobRunner:
+    """
+    Bounded process pool running jobs in the background. At most `workers`
+    jobs run at a time and at most `max_queue` more may wait in this process;
+    further submissions fail fast with JobQueueFull. Workers are spawned, not
+    forked, like the render pool's.
+    """
+
+    def __init__(self, store, workers=2, max_queue=16, timeout=120):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def submit(self, user_id, kind, params):
+        """Queue a job, or join an identical active one; returns (job, created)"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job kind {kind!r}')
+        if not self._slots.acquire(blocking=False):
+            job = self.store.find_active(user_id, kind, params)
+            if job is None:
+                raise JobQueueFull('Too many jobs queued')
+            return job, False
+
+        # A job may wait for every job queued ahead of it before it runs
+        queued_rounds = -(-self.max_queue // self.workers)
+        deadline = time.time() + self.timeout * (1 + queued_rounds) + 10
+        try:
+            job, created = self.store.create(user_id, kind, params, deadline)
+        except Exception:
+            self._slots.release()
+            raise
+        if not created:
+            self._slots.release()
+            return job, False
+
+        try:
+            future = self._get_executor().submit(
+                _execute, self.store.path, job['job_id'], kind, user_id, params, self.timeout
+            )
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset_executor()
+            self.store.fail(job['job_id'], 'Job worker unavailable')
+            raise
+        future.add_done_callback(lambda f: self._done(f, job['job_id']))
+        return job, True
+
+    def _done(self, future, job_id):
+        self._slots.release()
+        if future.cancelled():
+            self.store.fail(job_id, 'Job cancelled')
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Job {job_id} worker failed: {error}")
+            self.store.fail(job_id, 'Job worker failed')
+            if isinstance(error, BrokenProcessPool):
+                self._reset_executor()
+
+    def shutdown(self):
+        self._reset_executor()
+
+
+job_store = JobStore()
+
+job_runner = JobRunner(
+    job_store,
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_queue=int(os.environ.get('JOB_MAX_QUEUE', 16)),
+    timeout=int(os.environ.get('JOB_TIMEOUT', 120))
+)
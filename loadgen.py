@@ -0,0 +1,329 @@
+"""
+HTTP load generator for the dream journal API.
+
+Registers and logs in --users synthetic users, then sends a weighted mix of
+requests at a target rate for --duration seconds, either to a running
+server (--url) or in-process through the Flask test client (the default).
+The rate may ramp linearly (e.g. --rate 5:200) to find the point where a
+deployment stops keeping up.
+
+    gunicorn -w 2 app:app &
+    python loadgen.py --url http://127.0.0.1:8000 --users 50 --rate 20:200 --duration 60
+
+Requests are issued open-loop: latency is measured from the moment a request
+was scheduled, so time spent waiting for a free client thread counts against
+the server instead of silently lowering the offered load.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Relative weight of each operation in the default mix
+DEFAULT_MIX = {
+    'add_dream': 2,
+    'get_dreams': 5,
+    'get_insights': 1,
+    'analysis': 2,
+    'refresh_token': 0.5
+}
+
+# Route each operation is reported under
+ROUTE_LABELS = {
+    'add_dream': '/add_dream',
+    'get_dreams': '/get_dreams',
+    'get_insights': '/get_insights',
+    'analysis': '/dreams/analysis/<id>',
+    'refresh_token': '/refresh_token'
+}
+
+PASSWORD = 'loadgen-password'
+
+
+class HttpClient:
+    """Sends requests to a running server over keep-alive connections"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self._requests = requests
+        self._local = threading.local()
+
+    def request(self, method, path, token=None, json_body=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.request(method, self.base_url + path, json=json_body,
+                                   headers=_auth_headers(token), timeout=60)
+        return response.status_code, _json_or_none(response.content), response.headers
+
+
+class TestClient:
+    """Sends requests to the app in this process through Flask's test client"""
+
+    def __init__(self):
+        logging.disable(logging.WARNING)
+        from app import app
+        self.app = app
+
+    def request(self, method, path, token=None, json_body=None):
+        with self.app.test_client() as client:
+            response = client.open(path, method=method, json=json_body,
+                                   headers=_auth_headers(token))
+            return response.status_code, _json_or_none(response.data), response.headers
+
+
+def _auth_headers(token):
+    return {'Authorization': f'Bearer {token}'} if token else {}
+
+
+def _json_or_none(content):
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+
+class VirtualUser:
+    """A registered user's token and the ids of the dreams it has added"""
+
+    def __init__(self, username, token):
+        self.username = username
+        self.token = token
+        self.dream_ids = []
+        self.lock = threading.Lock()
+
+    def update_token(self, headers):
+        # token_required in app.py hands out renewed tokens in this header
+        new_token = headers.get('New-Token')
+        if new_token:
+            self.token = new_token
+
+
+DREAM_TEXTS = (
+    'I was flying over the water with my family and felt happy',
+    'Someone was chasing me through a dark school at night',
+    'I was falling from a tall building and woke up scared',
+    'A calm walk in the forest with an old friend',
+    'I was late for work and could not find the door',
+    'We were swimming in warm water under a bright sun'
+)
+
+
+def run_operation(client, user, operation, rng):
+    """Perform one operation as the user; returns (route label, status code)"""
+    if operation == 'analysis' and not user.dream_ids:
+        operation = 'add_dream'
+
+    if operation == 'add_dream':
+        status, body, headers = client.request('POST', '/add_dream', user.token, {
+            'dream_text': rng.choice(DREAM_TEXTS) + f' ({rng.randrange(10 ** 6)})'
+        })
+        if status == 201 and body:
+            with user.lock:
+                user.dream_ids.append(body['dream_id'])
+    elif operation == 'get_dreams':
+        status, body, headers = client.request('GET', '/get_dreams?limit=20', user.token)
+    elif operation == 'get_insights':
+        status, body, headers = client.request('GET', '/get_insights', user.token)
+    elif operation == 'analysis':
+        dream_id = rng.choice(user.dream_ids)
+        status, body, headers = client.request('GET', f'/dreams/analysis/{dream_id}', user.token)
+    elif operation == 'refresh_token':
+        status, body, headers = client.request('POST', '/refresh_token', user.token)
+        if status == 200 and body:
+            user.token = body['token']
+    else:
+        raise ValueError(f'Unknown operation {operation!r}')
+
+    user.update_token(headers)
+    return ROUTE_LABELS[operation], status
+
+
+def create_users(client, count, workers):
+    """Register and log in `count` users with unique names"""
+    prefix = uuid.uuid4().hex[:8]
+
+    def create(i):
+        username = f'load-{prefix}-{i}'
+        client.request('POST', '/register', json_body={'username': username, 'password': PASSWORD})
+        status, body, _ = client.request('POST', '/login', json_body={
+            'username': username, 'password': PASSWORD
+        })
+        if status != 200 or not body:
+            raise RuntimeError(f'Login failed for {username}: HTTP {status}')
+        return VirtualUser(username, body['token'])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(create, range(count)))
+
+
+def parse_mix(value):
+    """'add_dream=2,get_dreams=5' -> weights; unnamed operations get weight 0"""
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = dict.fromkeys(DEFAULT_MIX, 0.0)
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation {name!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('The mix needs at least one operation with a positive weight')
+    return mix
+
+
+def parse_rate(value):
+    """'50' -> (50, 50); '10:200' -> a linear ramp from 10 to 200 requests/s"""
+    start, _, end = value.partition(':')
+    start = float(start)
+    end = float(end) if end else start
+    if start <= 0 or end <= 0:
+        raise ValueError('Rates must be positive')
+    return start, end
+
+
+def run_load(client, users, mix, rate, duration, workers, seed=0):
+    """
+    Drive the mix open-loop for `duration` seconds and return one record per
+    request: (route, seconds since start when scheduled, latency, status).
+    """
+    rng = random.Random(seed)
+    operations = list(mix)
+    weights = [mix[name] for name in operations]
+    start_rate, end_rate = rate
+    records = []
+    records_lock = threading.Lock()
+
+    def execute(scheduled, user, operation, op_seed):
+        try:
+            route, status = run_operation(client, user, operation, random.Random(op_seed))
+        except Exception as e:
+            logger.debug(f"{operation} failed: {e}")
+            route, status = ROUTE_LABELS[operation], None
+        latency = time.perf_counter() - scheduled
+        with records_lock:
+            records.append((route, scheduled - started, latency, status))
+
+    started = time.perf_counter()
+    offset = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while offset < duration:
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(execute, scheduled, rng.choice(users),
+                            rng.choices(operations, weights)[0], rng.random())
+            # Instantaneous rate on the ramp decides the gap to the next request
+            current_rate = start_rate + (end_rate - start_rate) * offset / duration
+            offset += 1.0 / current_rate
+    return records, time.perf_counter() - started
+
+
+def summarize(records, elapsed, bucket_seconds=1.0):
+    """Latency percentiles and error rates per route, plus per-second throughput"""
+    by_route = defaultdict(list)
+    for record in records:
+        by_route[record[0]].append(record)
+
+    routes = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = np.array([row[2] for row in rows]) * 1000
+        errors = sum(1 for row in rows if row[3] is None or row[3] >= 400)
+        routes[route] = {
+            'requests': len(rows),
+            'errors': errors,
+            'error_rate': errors / len(rows),
+            'throughput': len(rows) / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max())
+        }
+
+    # Requests are bucketed by completion time
+    buckets = defaultdict(lambda: {'completed': 0, 'errors': 0, 'latencies': []})
+    for route, scheduled, latency, status in records:
+        bucket = buckets[int((scheduled + latency) // bucket_seconds)]
+        bucket['completed'] += 1
+        bucket['errors'] += status is None or status >= 400
+        bucket['latencies'].append(latency * 1000)
+    timeline = [{
+        'second': index * bucket_seconds,
+        'throughput': bucket['completed'] / bucket_seconds,
+        'errors': bucket['errors'],
+        'p95_ms': float(np.percentile(bucket['latencies'], 95))
+    } for index, bucket in sorted(buckets.items())]
+
+    total_errors = sum(route['errors'] for route in routes.values())
+    return {
+        'requests': len(records),
+        'elapsed_seconds': elapsed,
+        'throughput': len(records) / elapsed if elapsed else 0.0,
+        'error_rate': total_errors / len(records) if records else 0.0,
+        'routes': routes,
+        'timeline': timeline
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['requests']} requests in {summary['elapsed_seconds']:.1f}s "
+          f"({summary['throughput']:.1f}/s, {summary['error_rate']:.2%} errors)")
+    print(f"{'route':<24} {'reqs':>7} {'err%':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in summary['routes'].items():
+        print(f"{route:<24} {stats['requests']:>7} {stats['error_rate']:>7.2%} "
+              f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate HTTP load against the dream journal API')
+    parser.add_argument('--url', help='base URL of a running server (default: in-process test client)')
+    parser.add_argument('--users', type=int, default=20, help='synthetic users to create')
+    parser.add_argument('--rate', default='20', help='requests/s, or START:END for a linear ramp')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--workers', type=int, default=32, help='concurrent client threads')
+    parser.add_argument('--mix', help=f"weights, e.g. {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the full summary as JSON to this file')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+        rate = parse_rate(args.rate)
+    except ValueError as e:
+        parser.error(str(e))
+
+    client = HttpClient(args.url) if args.url else TestClient()
+    users = create_users(client, args.users, args.workers)
+    print(f"Created {len(users)} users; sending {args.rate} requests/s for {args.duration:g}s")
+
+    records, elapsed = run_load(client, users, mix, rate, args.duration, args.workers, args.seed)
+    summary = summarize(records, elapsed)
+    summary['config'] = {
+        'target': args.url or 'test-client',
+        'users': args.users,
+        'rate': rate,
+        'duration': args.duration,
+        'workers': args.workers,
+        'mix': mix
+    }
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Summary written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Request and analysis metrics in the Prometheus text format.
+
+Each process keeps its counters and histograms in memory and periodically
+writes them to METRICS_DIR/<pid>.json. GET /metrics merges the files of
+every process (gunicorn workers, render pool workers) so the totals are the
+same whichever worker answers the scrape. Files of exited processes are
+folded into METRICS_DIR/archive.json, so their totals survive a restart and
+a new process that reuses a pid does not overwrite them. METRICS_DIR defaults to a directory per parent process under the
+system temp directory. Set METRICS_TOKEN to require
+`Authorization: Bearer <token>` on /metrics.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Shared by the processes of one server; exported so spawned children inherit it
+METRICS_DIR = os.environ.setdefault('METRICS_DIR', os.path.join(
+    tempfile.gettempdir(), 'dream_journal_metrics', str(os.getppid())
+))
+
+# Seconds between writes of this process's metrics file
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ANALYSIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled', None),
+    'http_request_duration_seconds': ('histogram', 'Request latency', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Response body size', SIZE_BUCKETS),
+    'http_request_sql_statements': ('histogram', 'SQL statements executed per request', SQL_COUNT_BUCKETS),
+    'db_statements_total': ('counter', 'SQL statements executed while handling requests', None),
+    'db_statement_duration_seconds_total': ('counter', 'Time spent in SQL statements while handling requests', None),
+    'analysis_duration_seconds': ('histogram', 'Time per analysis stage', ANALYSIS_BUCKETS),
+    'cache_hits_total': ('counter', 'Cache hits', None),
+    'cache_misses_total': ('counter', 'Cache misses', None)
+}
+
+# Totals of exited processes, merged under ARCHIVE_LOCK
+ARCHIVE_NAME = 'archive'
+ARCHIVE_LOCK = '.archive.lock'
+
+
+class MetricsRegistry:
+    """Counters and histograms of one process, keyed by metric name and labels"""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        # pid that last wrote through this registry; differs in a forked child
+        self._flushed_pid = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # Per-bucket counts (made cumulative on export), then sum and count
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+        self.maybe_flush()
+
+    def add_collector(self, collect):
+        """
+        Register a callable returning [(counter name, labels, value)] read at
+        snapshot time, for components that already keep cumulative counters
+        """
+        self._collectors.append(collect)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), list(state)]
+                          for (name, labels), state in self._histograms.items()]
+        for collect in self._collectors:
+            try:
+                counters.extend([name, labels, value] for name, labels, value in collect())
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {e}")
+        return {'counters': counters, 'histograms': histograms}
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write this process's snapshot for the other processes to read"""
+        self._last_flush = time.monotonic()
+        pid = os.getpid()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._flushed_pid == pid:
+                self._write(self._path(pid), self.snapshot())
+                return
+            # A file under our pid was left by an exited process: archive it
+            # before the first write replaces it
+            with self._archive_lock():
+                self._archive(pid)
+                self._write(self._path(pid), self.snapshot())
+            self._flushed_pid = pid
+        except OSError as e:
+            logger.warning(f"Could not write metrics file: {e}")
+
+    def _write(self, path, snapshot):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    @contextmanager
+    def _archive_lock(self):
+        with open(os.path.join(self.directory, ARCHIVE_LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _archive(self, pid):
+        """Fold the file of pid into the archive and remove it; hold the archive lock"""
+        path = self._path(pid)
+        snapshot = _read(path)
+        if snapshot is None:
+            return
+        archive_path = self._path(ARCHIVE_NAME)
+        archived = _read(archive_path) or {'counters': [], 'histograms': []}
+        self._write(archive_path, _merge([archived, snapshot]))
+        os.remove(path)
+
+    def _archive_exited(self):
+        """Archive the files of processes that have exited"""
+        own_pid = os.getpid()
+        paths = glob.glob(os.path.join(self.directory, '*.json'))
+        pids = [int(name) for name in (os.path.basename(p)[:-5] for p in paths) if name.isdigit()]
+        pids = [pid for pid in pids if pid != own_pid and not _alive(pid)]
+        if not pids:
+            return
+        try:
+            with self._archive_lock():
+                for pid in pids:
+                    # Checked again under the lock: the pid may have been reused
+                    # by a process that has since written its first file
+                    if not _alive(pid):
+                        self._archive(pid)
+        except OSError as e:
+            logger.warning(f"Could not archive metrics files: {e}")
+
+    def collect(self):
+        """Snapshots of every process, with this process's taken live"""
+        self._archive_exited()
+        snapshots = [self.snapshot()]
+        own_path = self._path(os.getpid())
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == own_path:
+                continue
+            snapshot = _read(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        """All processes' metrics merged into the Prometheus text format"""
+        counters, histograms = _totals(self.collect())
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            samples = counters if metric_type == 'counter' else histograms
+            keys = sorted(key for key in samples if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for key in keys:
+                labels = key[1]
+                if metric_type == 'counter':
+                    lines.append(f'{name}{_labels(labels)} {_number(samples[key])}')
+                    continue
+                state = samples[key]
+                cumulative = 0
+                for bound, count in zip(buckets, state):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {state[-1]}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(state[-2])}')
+                lines.append(f'{name}_count{_labels(labels)} {state[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def timer(self, stage):
+        """Observe the duration of the block as analysis_duration_seconds{stage=...}"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('analysis_duration_seconds', time.perf_counter() - start, stage=stage)
+
+
+def _totals(snapshots):
+    """Sum snapshots into ({key: value}, {key: histogram state})"""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, state in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            merged = histograms.setdefault(key, [0] * len(state))
+            for i, value in enumerate(state):
+                merged[i] += value
+    return counters, histograms
+
+
+def _merge(snapshots):
+    """Sum snapshots into one snapshot"""
+    counters, histograms = _totals(snapshots)
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), state] for (name, labels), state in histograms.items()]
+    }
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+atexit.register(registry.flush)
+
+timer = registry.timer
+
+
+# Per-thread state of the request being handled
+_request = threading.local()
+
+
+def init_app(app):
+    """Install the request hooks, SQL counters and the /metrics route"""
+    from flask import Response, request
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @app.before_request
+    def _start_request_metrics():
+        _request.start = time.perf_counter()
+        _request.sql_count = 0
+        _request.sql_seconds = 0.0
+
+    @app.after_request
+    def _record_request_metrics(response):
+        start = getattr(_request, 'start', None)
+        if start is None:
+            return response
+        _request.start = None
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.inc('http_requests_total', route=route, method=request.method,
+                     status=str(response.status_code))
+        registry.observe('http_request_duration_seconds', time.perf_counter() - start,
+                         route=route, method=request.method)
+        size = response.calculate_content_length()
+        if size is not None:
+            registry.observe('http_response_size_bytes', size, route=route)
+        registry.observe('http_request_sql_statements', _request.sql_count, route=route)
+        if _request.sql_count:
+            registry.inc('db_statements_total', _request.sql_count, route=route)
+            registry.inc('db_statement_duration_seconds_total', _request.sql_seconds, route=route)
+        return response
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if getattr(_request, 'start', None) is not None:
+            conn.info.setdefault('metrics_statement_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_statement_start')
+        if starts and getattr(_request, 'start', None) is not None:
+            _request.sql_count += 1
+            _request.sql_seconds += time.perf_counter() - starts.pop()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        token = os.environ.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, DateTime, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy import Column, Integer, String, Text, Float, Date, DateTime, ForeignKey, Index, LargeBinary
+from sqlalchemy.orm import relationship
 import datetime
-
-Base = declarative_base()
+import json
+from database import Base, engine, db_session, read_db_session
 
 class User(Base):
     __tablename__ = 'users'
@@ -11,6 +10,8 @@ class User(Base):
     user_id = Column(Integer, primary_key=True)
     username = Column(String(50), unique=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
+    # Bumped by http_cache.bump_version on every change to the user's dreams; keys ETags
+    data_version = Column(Integer, nullable=False, default=0)
     
     dream_entries = relationship('DreamEntry', back_populates='user', cascade="all, delete-orphan")
 
@@ -21,16 +22,113 @@ class DreamEntry(Base):
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     dream_text = Column(Text, nullable=False)
     mood_score = Column(Float)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    # Sentiment computed once when the dream is added (MoodAnalyzer.analyze_components)
+    vader_compound = Column(Float)
+    vader_pos = Column(Float)
+    vader_neu = Column(Float)
+    vader_neg = Column(Float)
+    textblob_polarity = Column(Float)
+    theme_score = Column(Float)
+    combined_score = Column(Float)
+    detected_themes = Column(Text)  # JSON encoded list of theme names
+    # MoodAnalyzer.lexicon_version the components were computed with
+    analysis_version = Column(String(16))
     
     user = relationship('User', back_populates='dream_entries')
 
-# Add this line to allow both Dream and DreamEntry to work
-Dream = DreamEntry
+    # Serves per-user listings ordered by time (keyset pagination in /get_dreams)
+    __table_args__ = (
+        Index('ix_dream_entries_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+    def set_analysis(self, components, version):
+        """Store the output of MoodAnalyzer.analyze_components and the analyzer's lexicon_version"""
+        for key, value in components.items():
+            if key == 'detected_themes':
+                value = json.dumps(value)
+            setattr(self, key, value)
+        self.analysis_version = version
+
+    def get_analysis(self, version=None):
+        """
+        Return the stored sentiment components, or None if never scored or,
+        when `version` is given, scored by a different analyzer or lexicon
+        """
+        if self.combined_score is None:
+            return None
+        if version is not None and self.analysis_version != version:
+            return None
+        return {
+            'vader_compound': self.vader_compound,
+            'vader_pos': self.vader_pos,
+            'vader_neu': self.vader_neu,
+            'vader_neg': self.vader_neg,
+            'textblob_polarity': self.textblob_polarity,
+            'theme_score': self.theme_score,
+            'combined_score': self.combined_score,
+            'detected_themes': json.loads(self.detected_themes or '[]')
+        }
+
+class MoodDailyAggregate(Base):
+    """
+    Running mood statistics of one user's dreams on one (UTC) day.
+    Maintained on insert by mood_aggregates.record_dream and on delete by
+    mood_aggregates.remove_dream, so trend queries and the calendar and
+    report charts read one row per day instead of every dream.
+    """
+    __tablename__ = 'mood_daily_aggregates'
 
-# Database setup
-engine = create_engine('sqlite:///dream_journal.db', echo=True)
-Base.metadata.create_all(engine)
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    mood_sum = Column(Float, nullable=False, default=0.0)
+    mood_sum_sq = Column(Float, nullable=False, default=0.0)
+    # Sum of (position of the dream within the day) * mood, for regression slopes
+    mood_rank_sum = Column(Float, nullable=False, default=0.0)
+    negative_count = Column(Integer, nullable=False, default=0)
+    neutral_count = Column(Integer, nullable=False, default=0)
+    positive_count = Column(Integer, nullable=False, default=0)
+    # Counts per MoodAnalyzer.get_mood_label category
+    label_very_negative_count = Column(Integer, nullable=False, default=0)
+    label_negative_count = Column(Integer, nullable=False, default=0)
+    label_neutral_count = Column(Integer, nullable=False, default=0)
+    label_positive_count = Column(Integer, nullable=False, default=0)
+    label_very_positive_count = Column(Integer, nullable=False, default=0)
+    last_timestamp = Column(DateTime)
 
-# Create a session factory
-db_session = scoped_session(sessionmaker(bind=engine))
\ No newline at end of file
+# Dreams recorded in each hour of the day (UTC), one column per hour
+HOUR_COLUMNS = tuple(f'hour_{hour:02d}_count' for hour in range(24))
+for _column in HOUR_COLUMNS:
+    setattr(MoodDailyAggregate, _column, Column(Integer, nullable=False, default=0))
+
+class ThemeModelState(Base):
+    """Serialized per-user IncrementalThemeModel (see theme_model.py)"""
+    __tablename__ = 'theme_model_states'
+
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    state = Column(LargeBinary, nullable=False)
+    n_docs = Column(Integer, nullable=False, default=0)
+    # Highest dream_id folded into the model; later dreams are folded in on load
+    last_dream_id = Column(Integer)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class IdempotencyRecord(Base):
+    """
+    Response of a write request sent with an Idempotency-Key header, replayed
+    when the client retries with the same key (see idempotency.py)
+    """
+    __tablename__ = 'idempotency_keys'
+
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # Set by idempotency.remember; expired records are purged on later writes
+    expires_at = Column(DateTime, index=True)
+
+# Add this line to allow both Dream and DreamEntry to work
+Dream = DreamEntry
@@ -0,0 +1,319 @@
+import datetime
+import logging
+from sqlalchemy import and_, func, or_, update
+from models import DreamEntry, HOUR_COLUMNS, MoodDailyAggregate
+
+logger = logging.getLogger(__name__)
+
+# Aggregate column holding the count of each mood bucket
+BUCKET_COLUMNS = {
+    'negative': 'negative_count',
+    'neutral': 'neutral_count',
+    'positive': 'positive_count'
+}
+
+
+# Aggregate column holding the count of each MoodAnalyzer.get_mood_label category
+LABEL_COLUMNS = {
+    'Very Negative': 'label_very_negative_count',
+    'Negative': 'label_negative_count',
+    'Neutral': 'label_neutral_count',
+    'Positive': 'label_positive_count',
+    'Very Positive': 'label_very_positive_count'
+}
+
+# Columns summed by daily_rollup, besides the day
+ROLLUP_COLUMNS = ('count', 'mood_sum') + tuple(LABEL_COLUMNS.values()) + HOUR_COLUMNS
+
+
+def mood_bucket(score):
+    """Classify a mood score the same way MoodInsights does"""
+    return 'negative' if score < -0.1 else 'positive' if score > 0.1 else 'neutral'
+
+
+def bucket_clause(name):
+    """SQL condition on DreamEntry.mood_score matching mood_bucket(score) == name"""
+    score = DreamEntry.mood_score
+    if name == 'negative':
+        return score < -0.1
+    if name == 'positive':
+        return score > 0.1
+    return and_(score >= -0.1, score <= 0.1)
+
+
+def mood_label(score):
+    """Mood category of a score, as shown to users (see DreamAnalyzer for the same thresholds)"""
+    if score >= 0.5:
+        return "Very Positive"
+    elif score >= 0.1:
+        return "Positive"
+    elif score > -0.1:
+        return "Neutral"
+    elif score > -0.5:
+        return "Negative"
+    return "Very Negative"
+
+
+def _count_columns(score, timestamp):
+    """The bucket, label and hour columns a dream adds one to"""
+    return (BUCKET_COLUMNS[mood_bucket(score)], LABEL_COLUMNS[mood_label(score)],
+            HOUR_COLUMNS[timestamp.hour])
+
+
+def record_dream(session, dream):
+    """
+    Fold a flushed dream into its day's aggregate. The caller commits, so the
+    aggregate and the dream are written in the same transaction.
+    """
+    if dream.mood_score is None or dream.timestamp is None:
+        return
+
+    table = MoodDailyAggregate.__table__
+    score = dream.mood_score
+    day = dream.timestamp.date()
+    columns = _count_columns(score, dream.timestamp)
+
+    # In-order append: every right-hand side sees the pre-update row values
+    result = session.execute(
+        update(table).where(and_(
+            table.c.user_id == dream.user_id,
+            table.c.day == day,
+            or_(table.c.last_timestamp.is_(None), table.c.last_timestamp <= dream.timestamp)
+        )).values({
+            'count': table.c.count + 1,
+            'mood_sum': table.c.mood_sum + score,
+            'mood_sum_sq': table.c.mood_sum_sq + score * score,
+            'mood_rank_sum': table.c.mood_rank_sum + table.c.count * score,
+            **{column: table.c[column] + 1 for column in columns},
+            'last_timestamp': dream.timestamp
+        })
+    )
+    if result.rowcount:
+        return
+
+    if session.get(MoodDailyAggregate, (dream.user_id, day)) is None:
+        aggregate = MoodDailyAggregate(user_id=dream.user_id, day=day)
+        _fill_aggregate(aggregate, [dream])
+        session.add(aggregate)
+    else:
+        # The dream lands before others of the same day, so every rank shifts
+        rebuild_day(session, dream.user_id, day)
+
+
+def remove_dream(session, dream):
+    """
+    Delete a dream and recompute its day's aggregate from the remaining
+    dreams. The caller commits, so both changes land in one transaction.
+    """
+    session.delete(dream)
+    session.flush()
+    if dream.mood_score is not None and dream.timestamp is not None:
+        rebuild_day(session, dream.user_id, dream.timestamp.date())
+
+
+def _day_bounds(day):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    return start, start + datetime.timedelta(days=1)
+
+
+def day_window(start=None, end=None):
+    """Widen a [start, end) datetime window to the whole days it touches"""
+    if start is not None:
+        start = _day_bounds(start.date())[0]
+    if end is not None and end.time() != datetime.time.min:
+        end = _day_bounds(end.date())[1]
+    return start, end
+
+
+def _scored_rows(session, user_id, start=None, end=None):
+    """Mood scores and timestamps of a user's dreams in order"""
+    query = session.query(DreamEntry.timestamp, DreamEntry.mood_score).filter(
+        DreamEntry.user_id == user_id,
+        DreamEntry.mood_score.isnot(None)
+    )
+    if start is not None:
+        query = query.filter(DreamEntry.timestamp >= start)
+    if end is not None:
+        query = query.filter(DreamEntry.timestamp < end)
+    return query.order_by(DreamEntry.timestamp, DreamEntry.dream_id)
+
+
+def rebuild_day(session, user_id, day):
+    """Recompute one day's aggregate from the raw dream rows"""
+    start, end = _day_bounds(day)
+    aggregate = session.get(MoodDailyAggregate, (user_id, day))
+    rows = _scored_rows(session, user_id, start, end).all()
+
+    if not rows:
+        if aggregate is not None:
+            session.delete(aggregate)
+        return
+
+    if aggregate is None:
+        aggregate = MoodDailyAggregate(user_id=user_id, day=day)
+        session.add(aggregate)
+    _fill_aggregate(aggregate, rows)
+
+
+def _fill_aggregate(aggregate, rows):
+    """Set every statistic of the aggregate from the day's dreams in order"""
+    counts = dict.fromkeys(
+        list(BUCKET_COLUMNS.values()) + list(LABEL_COLUMNS.values()) + list(HOUR_COLUMNS), 0
+    )
+    aggregate.count = len(rows)
+    aggregate.mood_sum = sum(row.mood_score for row in rows)
+    aggregate.mood_sum_sq = sum(row.mood_score ** 2 for row in rows)
+    aggregate.mood_rank_sum = sum(rank * row.mood_score for rank, row in enumerate(rows))
+    for row in rows:
+        for column in _count_columns(row.mood_score, row.timestamp):
+            counts[column] += 1
+    for column, count in counts.items():
+        setattr(aggregate, column, count)
+    aggregate.last_timestamp = rows[-1].timestamp
+
+
+def rebuild_user(session, user_id):
+    """Recompute every daily aggregate of a user from the raw dream rows"""
+    session.query(MoodDailyAggregate).filter(
+        MoodDailyAggregate.user_id == user_id
+    ).delete(synchronize_session=False)
+
+    day_rows = []
+    current_day = None
+    for row in _scored_rows(session, user_id):
+        day = row.timestamp.date()
+        if day != current_day and day_rows:
+            _add_day(session, user_id, current_day, day_rows)
+            day_rows = []
+        current_day = day
+        day_rows.append(row)
+    if day_rows:
+        _add_day(session, user_id, current_day, day_rows)
+
+
+def _add_day(session, user_id, day, rows):
+    aggregate = MoodDailyAggregate(user_id=user_id, day=day)
+    _fill_aggregate(aggregate, rows)
+    session.add(aggregate)
+
+
+def rebuild_all(session):
+    """Backfill aggregates for every user that has dreams"""
+    user_ids = [row.user_id for row in session.query(DreamEntry.user_id).distinct()]
+    for user_id in user_ids:
+        rebuild_user(session, user_id)
+    logger.info(f"Rebuilt mood aggregates for {len(user_ids)} users")
+
+
+def window_stats(session, user_id, start):
+    """
+    Mood statistics of the user's dreams since `start`, in dream order:
+    count, mood_sum, mood_sum_sq, the regression slope of mood against
+    dream index and the bucket counts. Reads raw rows only for the partial
+    first day and one aggregate row per later day.
+    """
+    first_day_end = _day_bounds(start.date())[1]
+    count = 0
+    mood_sum = mood_sum_sq = rank_sum = 0.0
+    buckets = dict.fromkeys(BUCKET_COLUMNS, 0)
+
+    for row in _scored_rows(session, user_id, start, first_day_end):
+        rank_sum += count * row.mood_score
+        count += 1
+        mood_sum += row.mood_score
+        mood_sum_sq += row.mood_score ** 2
+        buckets[mood_bucket(row.mood_score)] += 1
+
+    aggregates = session.query(MoodDailyAggregate).filter(
+        MoodDailyAggregate.user_id == user_id,
+        MoodDailyAggregate.day > start.date()
+    ).order_by(MoodDailyAggregate.day)
+
+    for aggregate in aggregates:
+        # Ranks inside the day are offset by the dreams already counted
+        rank_sum += aggregate.mood_rank_sum + count * aggregate.mood_sum
+        count += aggregate.count
+        mood_sum += aggregate.mood_sum
+        mood_sum_sq += aggregate.mood_sum_sq
+        for name, column in BUCKET_COLUMNS.items():
+            buckets[name] += getattr(aggregate, column)
+
+    return {
+        'count': count,
+        'mood_sum': mood_sum,
+        'mood_sum_sq': mood_sum_sq,
+        'slope': _slope(count, mood_sum, rank_sum),
+        'buckets': buckets
+    }
+
+
+def dominant_bucket(session, user_id, start, buckets):
+    """
+    The most common of window_stats' buckets. A tie goes to the bucket of the
+    earliest dream since `start`, as Counter.most_common over the dreams in
+    order picks it; only a tie reads the raw rows.
+    """
+    top = max(buckets.values())
+    tied = [name for name, count in buckets.items() if count == top]
+    if len(tied) == 1:
+        return tied[0]
+
+    def first_seen(name):
+        return _scored_rows(session, user_id, start).filter(bucket_clause(name)).with_entities(
+            DreamEntry.timestamp, DreamEntry.dream_id
+        ).first()
+
+    return min(tied, key=lambda name: tuple(first_seen(name)))
+
+
+def daily_rollup(session, user_id=None, start=None, end=None):
+    """
+    One dict per day with the day, its dream count, mood sum, label counts
+    and hour-of-day counts (keys as in ROLLUP_COLUMNS), summed over all users
+    unless user_id is given. Feeds the calendar, distribution and report charts.
+    A [start, end) datetime window is widened to the whole days it touches
+    (see day_window).
+    """
+    table = MoodDailyAggregate.__table__
+    query = session.query(
+        table.c.day, *[func.sum(table.c[column]).label(column) for column in ROLLUP_COLUMNS]
+    )
+    if user_id is not None:
+        query = query.filter(table.c.user_id == user_id)
+    start, end = day_window(start, end)
+    if start is not None:
+        query = query.filter(table.c.day >= start.date())
+    if end is not None:
+        query = query.filter(table.c.day < end.date())
+    rows = query.group_by(table.c.day).order_by(table.c.day)
+    return [row._asdict() for row in rows]
+
+
+def _slope(n, sum_y, sum_xy):
+    """Least-squares slope of y against x = 0..n-1"""
+    if n < 2:
+        return 0.0
+    sum_x = n * (n - 1) / 2
+    sum_xx = (n - 1) * n * (2 * n - 1) / 6
+    return (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+
+
+def main():
+    """Backfill the aggregate table from existing dreams"""
+    import argparse
+    from database import init_db
+    from models import db_session
+    parser = argparse.ArgumentParser(description='Rebuild the daily mood aggregates from the dream rows')
+    parser.add_argument('--user', type=int, help='rebuild only this user_id')
+    args = parser.parse_args()
+
+    init_db()
+    if args.user is None:
+        rebuild_all(db_session)
+    else:
+        rebuild_user(db_session, args.user)
+    db_session.commit()
+
+
+if __name__ == "__main__":
+    main()
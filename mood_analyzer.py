@@ -2,36 +2,99 @@ from nltk.sentiment import SentimentIntensityAnalyzer
 from textblob import TextBlob
 import nltk
 import re
-from collections import Counter
-from dream_visualizer import DreamVisualizer
-import pandas as pd
-from database import SessionLocal
+from collections import Counter, deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from analysis_cache import AnalysisCache, text_digest
+from theme_lexicon import ThemeLexicon, default_lexicon, normalize
+import metrics
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+import os
+import threading
+from database import ReadSessionLocal
 from models import Dream
+from mood_aggregates import mood_label
+
+logger = logging.getLogger(__name__)
+
+# NLTK data shipped with the app, so no download is needed at startup
+NLTK_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nltk_data')
+if NLTK_DATA_DIR not in nltk.data.path:
+    nltk.data.path.insert(0, NLTK_DATA_DIR)
+
+# Numeric outputs of MoodAnalyzer.analyze_components, in batch array order
+SCORE_COMPONENTS = (
+    'vader_compound', 'vader_pos', 'vader_neu', 'vader_neg',
+    'textblob_polarity', 'theme_score', 'combined_score'
+)
+
+# Bump when the scoring or detailed-analysis output changes, to invalidate cached results
+ANALYZER_VERSION = 2
+
+# DataFrame columns load_dream_frame can select, and the model column of each
+FRAME_COLUMNS = {
+    'dream_id': Dream.dream_id,
+    'dream_text': Dream.dream_text,
+    'mood_score': Dream.mood_score,
+    'created_at': Dream.timestamp
+}
+
+FRAME_DTYPES = {
+    'dream_id': 'int64',
+    'dream_text': 'object',
+    'mood_score': 'float64'
+}
+
+# Rows fetched per round trip by load_dream_frame
+FRAME_CHUNK_SIZE = 5000
+
+# Size of the process pool shared by every analyze_batch call
+BATCH_POOL_WORKERS = int(os.environ.get('BATCH_POOL_WORKERS', os.cpu_count() or 1))
+
+# Analyzer owned by each analyze_batch worker process
+_worker_analyzer = None
+
+# Long-lived analyze_batch pool, created on first use
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
 
 class MoodAnalyzer:
-    def __init__(self):
-        # Download required NLTK data
-        try:
-            nltk.data.find('sentiment/vader_lexicon.zip')
-        except LookupError:
-            nltk.download('vader_lexicon')
-            nltk.download('punkt')
-            
+    def __init__(self, cache_size=1024, cache_max_bytes=16 * 1024 * 1024, lexicon=None):
+        # VADER lexicon is loaded from the bundled nltk_data directory
         self.sia = SentimentIntensityAnalyzer()
-        self.visualizer = DreamVisualizer()
+        self._visualizer = None
         
-        # Common dream themes and their associated emotions
-        self.dream_themes = {
-            'flying': 0.8,
-            'falling': -0.4,
-            'chase': -0.6,
-            'water': 0.3,
-            'family': 0.5,
-            'death': -0.8,
-            'school': -0.2,
-            'work': -0.3,
-            'love': 0.7
-        }
+        # Memoized get_detailed_analysis results, keyed by text digest and lexicon version
+        self.analysis_cache = AnalysisCache(cache_size, cache_max_bytes)
+        
+        # Dream themes and their associated emotions (theme_lexicon.json by default)
+        self.update_themes(lexicon or default_lexicon())
+
+    @property
+    def visualizer(self):
+        """DreamVisualizer, created on first use so scoring never imports sklearn or seaborn"""
+        if self._visualizer is None:
+            from dream_visualizer import DreamVisualizer
+            self._visualizer = DreamVisualizer()
+        return self._visualizer
+
+    def update_themes(self, dream_themes):
+        """
+        Replace the theme lexicon: a ThemeLexicon or a {theme: weight} dict.
+        Always change themes through this method so cached analyses are invalidated.
+        """
+        if not isinstance(dream_themes, ThemeLexicon):
+            dream_themes = ThemeLexicon(dream_themes)
+        self.lexicon = dream_themes
+        self.dream_themes = dream_themes.weights
+        self.lexicon_version = hashlib.sha256(
+            f'{ANALYZER_VERSION}:{dream_themes.version}'.encode('utf-8')
+        ).hexdigest()[:16]
+        self.analysis_cache.clear()
 
     def analyze_mood(self, dream_text):
         """
@@ -40,134 +103,310 @@ class MoodAnalyzer:
         2. TextBlob sentiment
         3. Theme-based analysis
         """
+        return self.analyze_components(dream_text)['combined_score']
+
+    def analyze_components(self, dream_text):
+        """
+        Compute every score behind analyze_mood in one pass.
+        Keys match the sentiment columns of DreamEntry so the result can be
+        stored when a dream is ingested.
+        """
         # Clean text
         cleaned_text = self._clean_text(dream_text)
         
         # Get VADER sentiment
-        vader_scores = self.sia.polarity_scores(dream_text)
+        with metrics.timer('vader'):
+            vader_scores = self.sia.polarity_scores(dream_text)
         vader_compound = vader_scores['compound']
         
         # Get TextBlob sentiment
-        blob = TextBlob(dream_text)
-        textblob_score = blob.sentiment.polarity
+        with metrics.timer('textblob'):
+            textblob_score = TextBlob(dream_text).sentiment.polarity
         
         # Get theme-based score
-        theme_score = self._analyze_themes(cleaned_text)
+        themes = self._find_themes(cleaned_text)
+        theme_score = self._score_themes(themes)
         
         # Combine scores (weighted average)
         final_score = (0.4 * vader_compound +
                       0.3 * textblob_score +
                       0.3 * theme_score)
         
-        # Ensure score is between -1 and 1
-        return max(min(final_score, 1.0), -1.0)
+        return {
+            'vader_compound': vader_compound,
+            'vader_pos': vader_scores['pos'],
+            'vader_neu': vader_scores['neu'],
+            'vader_neg': vader_scores['neg'],
+            'textblob_polarity': textblob_score,
+            'theme_score': theme_score,
+            # Ensure score is between -1 and 1
+            'combined_score': max(min(final_score, 1.0), -1.0),
+            'detected_themes': themes
+        }
+
+    def analyze_batch(self, texts, workers=None, chunksize=256):
+        """
+        Score many texts across the shared process pool, keeping at most
+        `workers` chunks in flight (1 scores in the calling thread).
+        Each worker loads VADER and TextBlob once. Results come back in input
+        order as a dict of NumPy arrays, one per SCORE_COMPONENTS entry, plus
+        the detected themes in CSR form: the themes of text i are
+        theme_names[theme_ids[theme_offsets[i]:theme_offsets[i + 1]]].
+        """
+        texts = list(texts)
+        workers = min(workers or BATCH_POOL_WORKERS, BATCH_POOL_WORKERS)
+        chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+
+        if workers <= 1 or len(chunks) <= 1:
+            results = [_score_chunk(chunk, self) for chunk in chunks]
+        else:
+            results = _map_batch_pool(chunks, self.lexicon, workers)
+
+        return _merge_batch_results(results, list(self.dream_themes))
 
     def _clean_text(self, text):
         """Remove special characters and convert to lowercase"""
         text = re.sub(r'[^a-zA-Z\s]', '', text)
         return text.lower()
 
+    def _find_themes(self, text):
+        """Return the known dream themes that occur in the cleaned text"""
+        return self.lexicon.themes(text.split())
+
+    def match_themes(self, dream_text):
+        """Every lexicon term in the text with its theme, token position and weight"""
+        return self.lexicon.match(normalize(dream_text))
+
     def _analyze_themes(self, text):
         """Analyze common dream themes and their emotional impact"""
-        words = text.split()
-        theme_scores = []
-        
-        for theme, score in self.dream_themes.items():
-            if theme in words:
-                theme_scores.append(score)
+        return self._score_themes(self._find_themes(text))
+
+    def _score_themes(self, themes):
+        """Average emotional weight of the given themes"""
+        theme_scores = [self.dream_themes[theme] for theme in themes]
         
         return sum(theme_scores) / len(theme_scores) if theme_scores else 0.0
 
     def get_mood_label(self, mood_score):
         """Convert numerical score to mood category"""
-        if mood_score >= 0.5:
-            return "Very Positive"
-        elif mood_score >= 0.1:
-            return "Positive"
-        elif mood_score > -0.1:
-            return "Neutral"
-        elif mood_score > -0.5:
-            return "Negative"
-        else:
-            return "Very Negative"
+        return mood_label(mood_score)
+
+    def get_detailed_analysis(self, dream_text, components=None):
+        """
+        Provide detailed mood analysis.
+        Pass the stored `components` of a DreamEntry to skip re-scoring the text.
+        Results are cached; treat the returned dict as read-only.
+        """
+        cache_key = f'{self.lexicon_version}:{text_digest(dream_text)}'
+        analysis = self.analysis_cache.get(cache_key)
+        if analysis is None:
+            analysis = self._build_detailed_analysis(dream_text, components)
+            self.analysis_cache.put(cache_key, analysis)
+        return analysis
 
-    def get_detailed_analysis(self, dream_text):
-        """Provide detailed mood analysis"""
+    def _build_detailed_analysis(self, dream_text, components):
+        """Uncached body of get_detailed_analysis"""
         cleaned_text = self._clean_text(dream_text)
-        vader_scores = self.sia.polarity_scores(dream_text)
-        
-        # Identify prominent themes
-        themes = [theme for theme in self.dream_themes.keys() 
-                 if theme in cleaned_text]
+        if components is None:
+            components = self.analyze_components(dream_text)
         
-        # Word frequency analysis
-        words = nltk.word_tokenize(cleaned_text)
+        # Word frequency analysis; the cleaned text is only letters and spaces,
+        # so splitting on whitespace matches word_tokenize without needing punkt
+        words = cleaned_text.split()
         word_freq = Counter(words).most_common(5)
         
         return {
-            'sentiment_scores': vader_scores,
-            'identified_themes': themes,
+            'sentiment_scores': {
+                'neg': components['vader_neg'],
+                'neu': components['vader_neu'],
+                'pos': components['vader_pos'],
+                'compound': components['vader_compound']
+            },
+            'identified_themes': components['detected_themes'],
+            'theme_matches': [match._asdict() for match in self.lexicon.match(words)],
             'common_words': word_freq,
-            'mood_score': self.analyze_mood(dream_text),
-            'mood_label': self.get_mood_label(self.analyze_mood(dream_text))
+            'mood_score': components['combined_score'],
+            'mood_label': self.get_mood_label(components['combined_score'])
         }
 
     # New visualization methods
-    def visualize_mood_patterns(self):
-        """Generate visualizations for mood patterns"""
-        db = SessionLocal()
+    def load_dream_frame(self, user_id=None, start=None, end=None,
+                         columns=('dream_text', 'mood_score', 'created_at'),
+                         chunksize=FRAME_CHUNK_SIZE):
+        """All the chunks of iter_dream_frames as one DataFrame"""
+        import pandas as pd
+        chunks = list(iter_dream_frames(user_id, start, end, columns, chunksize))
+        if not chunks:
+            return pd.DataFrame({name: pd.Series(dtype=FRAME_DTYPES.get(name, 'datetime64[ns]'))
+                                 for name in columns})
+        return pd.concat(chunks, ignore_index=True)
+
+    def load_daily_frame(self, user_id=None, start=None, end=None):
+        """
+        Daily mood rollup (see mood_aggregates.daily_rollup) as the input of
+        the calendar, weekly distribution and report
+        """
+        import pandas as pd
+        import mood_aggregates
+        db = ReadSessionLocal()
         try:
-            dreams = db.query(Dream).all()
-            dreams_df = pd.DataFrame([
-                {
-                    'dream_text': dream.content,
-                    'mood': dream.mood,
-                    'created_at': dream.created_at,
-                    'detailed_analysis': self.get_detailed_analysis(dream.content)
-                } for dream in dreams
-            ])
-            
-            # Add numerical mood scores to DataFrame
-            dreams_df['mood_score'] = dreams_df['detailed_analysis'].apply(
-                lambda x: x['mood_score']
+            return pd.DataFrame(
+                mood_aggregates.daily_rollup(db, user_id, start, end),
+                columns=('day',) + mood_aggregates.ROLLUP_COLUMNS
             )
-            
-            # Prepare data for visualization
-            df, vectors = self.visualizer.prepare_data(dreams_df)
-            
-            # Generate all visualizations
-            self.visualizer.plot_mood_calendar(df)
-            self.visualizer.plot_mood_distribution(df)
-            self.visualizer.plot_theme_clusters(vectors)
-            
-            return {
-                'dataframe': df,
-                'vectors': vectors,
-                'report': self.visualizer.generate_report(df)
-            }
-            
         finally:
             db.close()
 
-    def get_theme_visualization(self):
-        """Generate visualization for dream themes"""
-        db = SessionLocal()
-        try:
-            dreams = db.query(Dream).all()
-            dreams_df = pd.DataFrame([
-                {
-                    'dream_text': dream.content,
-                    'mood': dream.mood,
-                    'created_at': dream.created_at
-                } for dream in dreams
-            ])
-            
-            df, vectors = self.visualizer.prepare_data(dreams_df)
+    def visualize_mood_patterns(self, user_id=None, start=None, end=None):
+        """Generate visualizations for mood patterns of one user (all users by default)"""
+        # Prepare data for visualization
+        clusters, vectors = self.visualizer.prepare_data(dream_text_source(user_id, start, end))
+        daily = self.load_daily_frame(user_id, start, end)
+        
+        # Generate all visualizations
+        figures = [
+            self.visualizer.plot_mood_calendar(daily),
+            self.visualizer.plot_mood_distribution(daily),
             self.visualizer.plot_theme_clusters(vectors)
-            return df, vectors
-            
-        finally:
-            db.close()
+        ]
+        
+        return {
+            'clusters': clusters,
+            'daily': daily,
+            'vectors': vectors,
+            'figures': figures,
+            'report': self.visualizer.generate_report(daily)
+        }
+
+    def get_theme_visualization(self, user_id=None, start=None, end=None):
+        """Generate visualization for dream themes of one user (all users by default)"""
+        clusters, vectors = self.visualizer.prepare_data(dream_text_source(user_id, start, end))
+        fig = self.visualizer.plot_theme_clusters(vectors)
+        return clusters, vectors, fig
+
+def iter_dream_frames(user_id=None, start=None, end=None,
+                      columns=('dream_text', 'mood_score', 'created_at'),
+                      chunksize=FRAME_CHUNK_SIZE):
+    """
+    Dreams of one user (every user when user_id is None), optionally
+    limited to timestamps in [start, end), oldest first. Only the
+    requested FRAME_COLUMNS are selected, and rows are yielded chunksize at a
+    time as DataFrames with typed columns.
+    """
+    import pandas as pd
+    from sqlalchemy import select
+    query = select(*[FRAME_COLUMNS[name].label(name) for name in columns])
+    if user_id is not None:
+        query = query.where(Dream.user_id == user_id)
+    if start is not None:
+        query = query.where(Dream.timestamp >= start)
+    if end is not None:
+        query = query.where(Dream.timestamp < end)
+    query = query.order_by(Dream.timestamp, Dream.dream_id).execution_options(stream_results=True)
+
+    dtypes = {name: FRAME_DTYPES[name] for name in columns if name in FRAME_DTYPES}
+    parse_dates = [name for name in columns if name == 'created_at']
+    db = ReadSessionLocal()
+    try:
+        yield from pd.read_sql(query, db.connection(), chunksize=chunksize,
+                               dtype=dtypes, parse_dates=parse_dates)
+    finally:
+        db.close()
+
+def dream_text_source(user_id=None, start=None, end=None):
+    """
+    Input of DreamVisualizer.prepare_data: a picklable callable that streams
+    the dream texts afresh on every call, so render jobs read the dreams
+    themselves instead of being sent a DataFrame
+    """
+    return partial(iter_dream_frames, user_id, start, end, ('dream_text',))
+
+def _get_batch_executor():
+    """
+    The analyze_batch pool. Workers are spawned, not forked, so they never
+    inherit a threaded server's locks, and live as long as the process.
+    """
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ProcessPoolExecutor(
+                max_workers=BATCH_POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _batch_executor
+
+def _reset_batch_executor():
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is not None:
+            _batch_executor.shutdown(wait=False, cancel_futures=True)
+            _batch_executor = None
+
+def _map_batch_pool(chunks, lexicon, workers):
+    """Score chunks in the shared pool with at most `workers` in flight, in input order"""
+    executor = _get_batch_executor()
+    pending = deque()
+    results = []
+    try:
+        for chunk in chunks:
+            if len(pending) >= workers:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(_score_pool_chunk, chunk, lexicon))
+        while pending:
+            results.append(pending.popleft().result())
+    except BrokenProcessPool:
+        logger.error("analyze_batch worker died; restarting pool")
+        _reset_batch_executor()
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+    return results
+
+def _score_pool_chunk(texts, lexicon):
+    """Score a chunk in a pool worker, reloading its analyzer only when the lexicon changed"""
+    global _worker_analyzer
+    if _worker_analyzer is None:
+        _worker_analyzer = MoodAnalyzer(lexicon=lexicon)
+    elif _worker_analyzer.lexicon.version != lexicon.version:
+        _worker_analyzer.update_themes(lexicon)
+    return _score_chunk(texts)
+
+def _score_chunk(texts, analyzer=None):
+    """Score one chunk of texts into a (len(texts), components) array plus theme ids"""
+    analyzer = analyzer or _worker_analyzer
+    theme_index = {theme: i for i, theme in enumerate(analyzer.dream_themes)}
+    scores = np.empty((len(texts), len(SCORE_COMPONENTS)), dtype=np.float64)
+    theme_ids = []
+    theme_counts = np.empty(len(texts), dtype=np.int64)
+
+    for row, text in enumerate(texts):
+        components = analyzer.analyze_components(text)
+        scores[row] = [components[name] for name in SCORE_COMPONENTS]
+        theme_ids.extend(theme_index[theme] for theme in components['detected_themes'])
+        theme_counts[row] = len(components['detected_themes'])
+
+    if analyzer is _worker_analyzer:
+        # Pool workers exit without running atexit handlers
+        metrics.registry.flush()
+    return scores, np.asarray(theme_ids, dtype=np.int32), theme_counts
+
+def _merge_batch_results(results, theme_names):
+    """Concatenate per-chunk results of analyze_batch in order"""
+    if results:
+        scores = np.concatenate([r[0] for r in results])
+        theme_ids = np.concatenate([r[1] for r in results])
+        theme_counts = np.concatenate([r[2] for r in results])
+    else:
+        scores = np.empty((0, len(SCORE_COMPONENTS)))
+        theme_ids = np.empty(0, dtype=np.int32)
+        theme_counts = np.empty(0, dtype=np.int64)
+
+    batch = {name: scores[:, i] for i, name in enumerate(SCORE_COMPONENTS)}
+    batch['theme_ids'] = theme_ids
+    batch['theme_offsets'] = np.concatenate([[0], np.cumsum(theme_counts)])
+    batch['theme_names'] = theme_names
+    return batch
 
 # Example usage
 def main():
@@ -2,10 +2,10 @@ import logging
 from datetime import datetime, timedelta
 from sqlalchemy import func
 from collections import Counter
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
 import numpy as np
-from models import DreamEntry, db_session
+from models import DreamEntry, db_session, read_db_session
+import mood_aggregates
+import theme_model
 
 # Configure Logger
 logging.basicConfig(
@@ -22,39 +22,38 @@ class MoodInsights:
     def __init__(self, user_id):
         self.user_id = user_id
 
-    def get_mood_trends(self, days=30):
+    def get_mood_trends(self, days=30, recompute=False):
         """
         Analyze mood trends for the past given days.
         :param days: Number of days to analyze (default: 30).
+        :param recompute: Recompute from raw dream rows instead of the daily
+            aggregates (slower; used to verify the aggregates).
         :return: Dictionary with average mood, trend, and dominant mood.
         """
         try:
             end_date = datetime.utcnow()
             start_date = end_date - timedelta(days=days)
 
-            dreams = db_session.query(DreamEntry).filter(
-                DreamEntry.user_id == self.user_id,
-                DreamEntry.timestamp >= start_date
-            ).order_by(DreamEntry.timestamp).all()
+            if recompute:
+                return self._mood_trends_from_rows(start_date)
 
-            if not dreams:
+            stats = mood_aggregates.window_stats(read_db_session, self.user_id, start_date)
+            if not stats['count']:
                 return {
                     'average_mood': None,
                     'trend': None,
                     'dominant_mood': "No data available"
                 }
 
-            mood_scores = [dream.mood_score for dream in dreams]
-
             # Calculate metrics
-            average_mood = np.mean(mood_scores)
-            trend = self._calculate_trend(mood_scores)
-            dominant_mood = self._get_dominant_mood(mood_scores)
+            average_mood = stats['mood_sum'] / stats['count']
+            trend = self._classify_slope(stats['slope']) if stats['count'] >= 2 else 'neutral'
+            dominant_mood = mood_aggregates.dominant_bucket(
+                read_db_session, self.user_id, start_date, stats['buckets']
+            )
 
-            logger.info(f"Mood Scores: {mood_scores}")
-            logger.info(f"Average Mood: {average_mood}")
-            logger.info(f"Trend: {trend}")
-            logger.info(f"Dominant Mood: {dominant_mood}")
+            logger.debug(f"Mood trends over {stats['count']} dreams: "
+                         f"average={average_mood}, trend={trend}, dominant={dominant_mood}")
 
             return {
                 'average_mood': float(average_mood),
@@ -70,11 +69,38 @@ class MoodInsights:
                 'dominant_mood': "Error determining dominant mood"
             }
 
+    def _mood_trends_from_rows(self, start_date):
+        """Compute get_mood_trends from every dream row in the window"""
+        dreams = read_db_session.query(DreamEntry).filter(
+            DreamEntry.user_id == self.user_id,
+            DreamEntry.timestamp >= start_date,
+            DreamEntry.mood_score.isnot(None)
+        ).order_by(DreamEntry.timestamp, DreamEntry.dream_id).all()
+
+        if not dreams:
+            return {
+                'average_mood': None,
+                'trend': None,
+                'dominant_mood': "No data available"
+            }
+
+        mood_scores = [dream.mood_score for dream in dreams]
+
+        return {
+            'average_mood': float(np.mean(mood_scores)),
+            'trend': self._calculate_trend(mood_scores),
+            'dominant_mood': self._get_dominant_mood(mood_scores)
+        }
+
     def _calculate_trend(self, scores):
         """Calculate mood trend using a linear regression slope."""
         if len(scores) < 2:
             return 'neutral'
         slope = np.polyfit(range(len(scores)), scores, 1)[0]
+        return self._classify_slope(slope)
+
+    def _classify_slope(self, slope):
+        """Map a regression slope to a trend label."""
         if slope > 0.1:
             return 'improving'
         elif slope < -0.1:
@@ -83,58 +109,33 @@ class MoodInsights:
 
     def _get_dominant_mood(self, scores):
         """Determine the dominant mood based on mood scores."""
-        moods = [
-            'negative' if s < -0.1 else 'positive' if s > 0.1 else 'neutral'
-            for s in scores
-        ]
+        moods = [mood_aggregates.mood_bucket(s) for s in scores]
         return Counter(moods).most_common(1)[0][0]
 
     def find_recurring_themes(self, min_dreams=3):
         """
         Identify recurring themes in user dreams.
+        Reads the user's incremental theme model, folding in any new dreams.
         :param min_dreams: Minimum number of dreams required for analysis.
         :return: List of themes with keywords and frequency.
         """
         try:
-            dreams = db_session.query(DreamEntry).filter(
-                DreamEntry.user_id == self.user_id
-            ).all()
+            model = theme_model.load_user_model(db_session, self.user_id)
+            # load_user_model may have built, extended and stored the model
+            db_session.commit()
 
-            if len(dreams) < min_dreams:
+            if model.n_docs < min_dreams:
                 return None
 
-            texts = [dream.dream_text for dream in dreams]
-            vectorizer = TfidfVectorizer(stop_words='english', max_features=100)
-            X = vectorizer.fit_transform(texts)
-
-            n_clusters = min(3, len(texts))
-            kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-            clusters = kmeans.fit_predict(X)
-
-            themes = []
-            for i in range(n_clusters):
-                cluster_texts = [text for text, cluster in zip(texts, clusters) if cluster == i]
-                if cluster_texts:
-                    top_terms = self._get_top_terms(vectorizer, kmeans, i)
-                    themes.append({
-                        'theme': f"Theme {i + 1}",
-                        'keywords': top_terms,
-                        'frequency': len(cluster_texts)
-                    })
-
-            logger.info(f"Recurring themes found: {themes}")
+            themes = model.themes()
+            logger.debug(f"Recurring themes found: {themes}")
             return themes
 
         except Exception as e:
+            db_session.rollback()
             logger.error(f"Error finding recurring themes: {str(e)}")
             return None
 
-    def _get_top_terms(self, vectorizer, kmeans, cluster_idx, top_n=3):
-        """Get the top terms for a given cluster."""
-        order_centroids = kmeans.cluster_centers_.argsort()[:, ::-1]
-        terms = vectorizer.get_feature_names_out()
-        return [terms[i] for i in order_centroids[cluster_idx, :top_n]]
-
     def generate_feedback(self):
         """
         Generate personalized feedback based on mood trends and recurring themes.
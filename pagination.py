@@ -0,0 +1,60 @@
+import base64
+import datetime
+import json
+from sqlalchemy import and_, or_
+
+# Page size limits for list endpoints
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class PaginationError(ValueError):
+    """Raised when a client supplies an invalid limit, cursor or date"""
+
+
+def encode_cursor(timestamp, dream_id):
+    """Encode the (timestamp, dream_id) of the last row into an opaque cursor"""
+    payload = json.dumps([timestamp.isoformat(), dream_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor back into (timestamp, dream_id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, dream_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.datetime.fromisoformat(timestamp), int(dream_id)
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Parse the page size, clamped to [1, maximum]"""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    return max(1, min(limit, maximum))
+
+
+def parse_date(value, name):
+    """Parse an optional ISO-8601 date/datetime query parameter"""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be an ISO-8601 date')
+
+
+def keyset_filter(query, timestamp_col, id_col, cursor):
+    """Restrict a newest-first query to the rows that come after the cursor"""
+    if not cursor:
+        return query
+    timestamp, row_id = decode_cursor(cursor)
+    return query.filter(or_(
+        timestamp_col < timestamp,
+        and_(timestamp_col == timestamp, id_col < row_id)
+    ))
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Bump when plots change so previously cached renders are no longer served
+RENDERER_VERSION = 1
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{32}(-[a-z0-9_]+)?$')
+
+# Holds the generated key secret inside the cache directory
+SECRET_FILE = 'key_secret'
+
+
+def make_key(*parts):
+    """
+    Content address of a render: digest of the renderer version and the inputs.
+    The cache's key secret keeps the keys, and so the /dreams/renders URLs,
+    unguessable while staying the same across workers and restarts.
+    """
+    text = ':'.join(str(part) for part in (RENDERER_VERSION, render_cache.key_secret) + parts)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class RenderCache:
+    """
+    Directory of rendered PNGs and JSON manifests, evicted least recently used
+    first once the total size exceeds max_bytes. Files are written atomically
+    so several worker processes can share one directory.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, key_secret=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.key_secret = key_secret or self._load_secret()
+
+    def _load_secret(self):
+        """Secret shared by every process using this directory, generated by the first one"""
+        path = os.path.join(self.directory, SECRET_FILE)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+            try:
+                # Links only if absent, so concurrent workers agree on one secret
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(path) as f:
+            return f.read().strip()
+
+    def _path(self, key, suffix):
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f'Invalid render cache key: {key}')
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix='.png'):
+        """Return the cached bytes for key, or None"""
+        path = self._path(key, suffix)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Reads refresh the access time used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data, suffix='.png'):
+        """Store bytes under key, then evict old entries if over budget"""
+        path = self._path(key, suffix)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def get_json(self, key):
+        data = self.get(key, '.json')
+        return json.loads(data) if data is not None else None
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value).encode('utf-8'), '.json')
+
+    def get_manifest(self, key):
+        """Manifest of a cached render, or None unless all of its figures are still on disk"""
+        manifest = self.get_json(key)
+        if manifest is None:
+            return None
+        for name in manifest['figures']:
+            if self.get(f'{key}-{name}') is None:
+                return None
+        return manifest
+
+    def get_render(self, key):
+        """(manifest, {figure name: PNG bytes}) of a cached render, or None unless all of it is still on disk"""
+        manifest = self.get_json(key)
+        if manifest is None:
+            return None
+        figures = {}
+        for name in manifest['figures']:
+            figures[name] = self.get(f'{key}-{name}')
+            if figures[name] is None:
+                return None
+        return manifest, figures
+
+    def put_render(self, key, figures, extra):
+        """Cache PNG bytes per figure plus a manifest describing the render"""
+        for name, png in figures.items():
+            self.put(f'{key}-{name}', png)
+        manifest = dict(extra, figures=list(figures))
+        self.put_json(key, manifest)
+        return manifest
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.tmp') or entry.name == SECRET_FILE or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            logger.info(f"Render cache evicted down to {total} bytes")
+
+
+render_cache = RenderCache(
+    os.environ.get('RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dream_journal_renders')),
+    int(os.environ.get('RENDER_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+    os.environ.get('RENDER_KEY_SECRET')
+)
@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RenderPoolBusy(Exception):
+    """Raised when the render queue is full; the caller should retry later"""
+
+
+class RenderTimeout(Exception):
+    """Raised when a render job exceeds its time limit"""
+
+
+def _alarm_handler(signum, frame):
+    raise RenderTimeout('Render job timed out')
+
+
+def _run_job(fn, timeout, args):
+    """Run fn inside a worker process, aborting it after `timeout` seconds"""
+    signal.signal(signal.SIGALRM, _alarm_handler)
+    signal.alarm(timeout)
+    try:
+        return fn(*args)
+    finally:
+        signal.alarm(0)
+        # Workers exit without running atexit handlers
+        metrics.registry.flush()
+
+
+class RenderPool:
+    """
+    Bounded process pool for matplotlib work. At most `workers` jobs run at a
+    time and at most `max_queue` more may wait; further submissions fail fast
+    with RenderPoolBusy so rendering cannot tie up every request thread.
+    Workers are spawned, not forked, so they never inherit a threaded server's
+    locks or pyplot state.
+    """
+
+    def __init__(self, workers=2, max_queue=8, timeout=60):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def run(self, fn, *args, timeout=None):
+        """Run fn(*args) in the pool and wait for its result"""
+        timeout = timeout or self.timeout
+        if not self._slots.acquire(blocking=False):
+            raise RenderPoolBusy('Too many render jobs queued')
+
+        try:
+            future = self._get_executor().submit(_run_job, fn, timeout, args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset_executor()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            # The worker enforces the run time itself; this bounds queueing plus spawn time
+            queued_rounds = -(-self.max_queue // self.workers)
+            return future.result(timeout=timeout * (1 + queued_rounds) + 10)
+        except FutureTimeoutError:
+            future.cancel()
+            raise RenderTimeout('Render job timed out waiting in the queue')
+        except BrokenProcessPool:
+            logger.error("Render pool worker died; restarting pool")
+            self._reset_executor()
+            raise
+
+    def shutdown(self):
+        self._reset_executor()
+
+
+render_pool = RenderPool(
+    workers=int(os.environ.get('RENDER_POOL_WORKERS', 2)),
+    max_queue=int(os.environ.get('RENDER_POOL_MAX_QUEUE', 8)),
+    timeout=int(os.environ.get('RENDER_TIMEOUT', 60))
+)
@@ -0,0 +1,170 @@
+import argparse
+import html
+import logging
+import re
+from sqlalchemy import DateTime, Float, bindparam, inspect, text
+
+logger = logging.getLogger(__name__)
+
+# FTS5 index over dream_entries.dream_text. It is an external-content table:
+# the text lives only in dream_entries and the triggers below keep the index
+# in sync. user_id is indexed too so a user's matches are intersected inside
+# the index instead of being filtered out of every user's matches.
+SEARCH_TABLE = 'dream_search'
+
+SEARCH_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        dream_text, user_id,
+        content='dream_entries', content_rowid='dream_id',
+        tokenize='porter unicode61', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_ai AFTER INSERT ON dream_entries BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, dream_text, user_id)
+        VALUES (new.dream_id, new.dream_text, new.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_ad AFTER DELETE ON dream_entries BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, dream_text, user_id)
+        VALUES ('delete', old.dream_id, old.dream_text, old.user_id);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_au AFTER UPDATE OF dream_text, user_id ON dream_entries BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, dream_text, user_id)
+        VALUES ('delete', old.dream_id, old.dream_text, old.user_id);
+        INSERT INTO {SEARCH_TABLE}(rowid, dream_text, user_id)
+        VALUES (new.dream_id, new.dream_text, new.user_id);
+    END"""
+]
+
+# Words around each match in a snippet
+SNIPPET_TOKENS = 16
+
+# Private-use characters marking matches until the snippet is HTML-escaped
+_MARK_START = '\ue000'
+_MARK_END = '\ue001'
+
+_QUERY_PART = re.compile(r'"([^"]*)"?|(\S+)')
+_WORD = re.compile(r'\w+')
+
+
+class SearchQueryError(ValueError):
+    """Raised when a search query contains nothing to search for"""
+
+
+def is_supported(bind):
+    return bind.dialect.name == 'sqlite'
+
+
+def ensure_index(bind):
+    """Create the index and its triggers if missing, filling it from existing dreams"""
+    if not is_supported(bind):
+        logger.info("Full-text search needs SQLite FTS5; /search_dreams is disabled")
+        return
+    created = not inspect(bind).has_table(SEARCH_TABLE)
+    with bind.begin() as conn:
+        for statement in SEARCH_DDL:
+            conn.execute(text(statement))
+        if created:
+            _rebuild(conn)
+
+
+def rebuild(bind):
+    """Rebuild the index from dream_entries and merge its segments"""
+    with bind.begin() as conn:
+        _rebuild(conn)
+        conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')"))
+
+
+def _rebuild(conn):
+    conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+
+
+def compile_query(query):
+    """
+    Turn user input into an FTS5 query. Words are ANDed, "quoted text" is a
+    phrase and a trailing * makes a prefix query. Every token is quoted so
+    FTS5 operators and column names in the input are matched as plain words.
+    """
+    parts = []
+    for phrase, word in _QUERY_PART.findall(query or ''):
+        words = _WORD.findall(phrase or word)
+        if not words:
+            continue
+        part = '"' + ' '.join(words) + '"'
+        if word.endswith('*'):
+            part += '*'
+        parts.append(part)
+    if not parts:
+        raise SearchQueryError('q must contain at least one word')
+    return ' AND '.join(parts)
+
+
+def search(session, user_id, query, start=None, end=None, min_mood=None,
+           max_mood=None, limit=20, offset=0):
+    """
+    The user's dreams matching the query, best bm25 match first, with a
+    highlighted snippet. Fetches one extra row to tell whether more follow.
+    """
+    # The user's terms are scoped to dream_text so they cannot match the user_id column
+    match = f'user_id : "{int(user_id)}" AND dream_text : ({compile_query(query)})'
+    filters = []
+    params = [
+        bindparam('match', match),
+        bindparam('mark_start', _MARK_START),
+        bindparam('mark_end', _MARK_END),
+        bindparam('limit', limit + 1),
+        bindparam('offset', offset)
+    ]
+    for column, operator, name, value, value_type in (
+        ('timestamp', '>=', 'start', start, DateTime),
+        ('timestamp', '<', 'end', end, DateTime),
+        ('mood_score', '>=', 'min_mood', min_mood, Float),
+        ('mood_score', '<=', 'max_mood', max_mood, Float)
+    ):
+        if value is not None:
+            filters.append(f' AND d.{column} {operator} :{name}')
+            params.append(bindparam(name, value, type_=value_type))
+
+    statement = text(f"""
+        SELECT d.dream_id, d.timestamp, d.mood_score,
+               snippet({SEARCH_TABLE}, 0, :mark_start, :mark_end, '…', {SNIPPET_TOKENS}) AS snippet,
+               bm25({SEARCH_TABLE}, 1.0, 0.0) AS score
+        FROM {SEARCH_TABLE}
+        JOIN dream_entries AS d ON d.dream_id = {SEARCH_TABLE}.rowid
+        WHERE {SEARCH_TABLE} MATCH :match{''.join(filters)}
+        ORDER BY score, d.dream_id
+        LIMIT :limit OFFSET :offset
+    """).bindparams(*params).columns(timestamp=DateTime)
+    rows = session.execute(statement).all()
+
+    results = [{
+        'dream_id': row.dream_id,
+        'timestamp': row.timestamp,
+        'mood_score': row.mood_score,
+        'snippet': _highlight(row.snippet),
+        # bm25() is lower-is-better; flip it so larger means more relevant
+        'score': -row.score
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
+
+
+def _highlight(snippet):
+    """HTML-escape the snippet and wrap the matches in <mark>"""
+    return html.escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def main():
+    """Create or rebuild the search index of an existing database"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--rebuild', action='store_true',
+                        help='re-index every dream even if the index exists')
+    args = parser.parse_args()
+
+    from database import engine, init_db
+    init_db()
+    if args.rebuild and is_supported(engine):
+        rebuild(engine)
+        logger.info("Rebuilt the dream search index")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
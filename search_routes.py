@@ -0,0 +1,74 @@
+from flask import Blueprint, jsonify, request
+from sqlalchemy.exc import SQLAlchemyError
+from models import read_db_session
+from auth_middleware import token_required
+from pagination import PaginationError, parse_date, parse_limit
+import logging
+import search_index
+
+logger = logging.getLogger(__name__)
+
+search_bp = Blueprint('search', __name__)
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+@search_bp.route('/search_dreams', methods=['GET'])
+@token_required
+def search_dreams(current_user):
+    """
+    Full-text search over the user's dreams, best match first.
+    Query parameters: q (words, "phrases" and prefix* terms), start/end
+    (ISO-8601 dates), min_mood/max_mood, limit and offset (next_offset of
+    the previous page). Snippets are HTML-escaped with matches in <mark>.
+    """
+    if not search_index.is_supported(read_db_session.get_bind()):
+        return jsonify({'message': 'Search is not available on this database'}), 501
+
+    try:
+        offset = _parse_offset(request.args.get('offset'))
+        results, has_more = search_index.search(
+            read_db_session,
+            current_user.user_id,
+            request.args.get('q', ''),
+            start=parse_date(request.args.get('start'), 'start'),
+            end=parse_date(request.args.get('end'), 'end'),
+            min_mood=_parse_mood(request.args.get('min_mood'), 'min_mood'),
+            max_mood=_parse_mood(request.args.get('max_mood'), 'max_mood'),
+            limit=parse_limit(request.args.get('limit'), DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT),
+            offset=offset
+        )
+    except (PaginationError, search_index.SearchQueryError) as e:
+        return jsonify({'message': str(e)}), 400
+    except SQLAlchemyError as e:
+        logger.error(f"Database error while searching dreams: {str(e)}")
+        return jsonify({'message': 'Database error occurred'}), 500
+
+    for result in results:
+        result['timestamp'] = result['timestamp'].isoformat() if result['timestamp'] else None
+    return jsonify({
+        'results': results,
+        'next_offset': offset + len(results) if has_more else None
+    })
+
+
+def _parse_mood(value, name):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be a number')
+
+
+def _parse_offset(value):
+    if value is None or value == '':
+        return 0
+    try:
+        offset = int(value)
+    except ValueError:
+        raise PaginationError('offset must be an integer')
+    if offset < 0:
+        raise PaginationError('offset must not be negative')
+    return offset
@@ -0,0 +1,99 @@
+"""
+Startup helpers.
+
+warmup() loads the analysis models ahead of the first request. Run the app
+with PRELOAD_MODELS=1 and `gunicorn --preload app:app` so this happens once in
+the master and forked workers share the loaded models copy-on-write.
+
+`python startup.py` prints how long importing the app takes, broken down by
+top-level module; add --warmup to also time each warm-up step.
+"""
+import argparse
+import logging
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def warmup():
+    """Load the lazily initialized subsystems now; returns seconds per step"""
+    timings = {}
+
+    def step(name, fn):
+        start = time.perf_counter()
+        fn()
+        timings[name] = time.perf_counter() - start
+
+    def load_mood_analyzer():
+        from dream_routes import get_mood_analyzer
+        # Scoring once also loads TextBlob's lexicon, which is read lazily
+        get_mood_analyzer().analyze_components('warm up')
+
+    def load_theme_model():
+        from theme_model import IncrementalThemeModel
+        IncrementalThemeModel().partial_fit(['warm up'])
+
+    def load_insights():
+        import mood_insights  # noqa: F401
+
+    def load_visualizer():
+        import dream_visualizer  # noqa: F401
+
+    step('mood_analyzer', load_mood_analyzer)
+    step('theme_model', load_theme_model)
+    step('mood_insights', load_insights)
+    step('dream_visualizer', load_visualizer)
+
+    logger.info("Warm-up finished: " + ", ".join(
+        f"{name}={seconds:.2f}s" for name, seconds in timings.items()
+    ))
+    return timings
+
+
+def import_report(module='app'):
+    """
+    Import `module` in a fresh interpreter with -X importtime and return
+    [(top-level module, seconds)] sorted by cost, plus the total.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True
+    )
+    self_times = defaultdict(int)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, raw_name = line[len('import time:'):].split('|')
+        name = raw_name.strip()
+        self_times[name.split('.')[0]] += int(self_us)
+        if raw_name == ' ' + module:
+            total = int(cumulative_us)
+    ranked = sorted(self_times.items(), key=lambda item: item[1], reverse=True)
+    return [(name, us / 1e6) for name, us in ranked], total / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report startup cost of the app')
+    parser.add_argument('--module', default='app', help='module to import (default: app)')
+    parser.add_argument('--top', type=int, default=15, help='number of modules to list')
+    parser.add_argument('--warmup', action='store_true', help='also time warmup()')
+    args = parser.parse_args()
+
+    ranked, total = import_report(args.module)
+    print(f"Import of {args.module}: {total:.2f}s")
+    for name, seconds in ranked[:args.top]:
+        print(f"  {name:<30} {seconds:8.3f}s")
+
+    if args.warmup:
+        logging.disable(logging.CRITICAL)
+        import app  # noqa: F401
+        for name, seconds in warmup().items():
+            print(f"  warmup {name:<23} {seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -262,27 +262,44 @@ function startTokenCheck() {
     }, 60000);
 }
 
-async function loadInsights() {
-    try {
-        const response = await authenticatedFetch('/get_dreams');
-        
+// /get_dreams is paginated newest first; follow next_cursor to collect the
+// whole history, returned oldest first like the unpaginated endpoint was.
+// Resolves to null when authenticatedFetch gave no response.
+async function fetchAllDreams() {
+    const dreams = [];
+    let cursor = null;
+    do {
+        let url = '/get_dreams?limit=500';
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+        const response = await authenticatedFetch(url);
         if (!response) {
             console.log('No response from authenticatedFetch');
-            return;
+            return null;
         }
-
         if (!response.ok) {
-            throw new Error(`Failed to fetch insights: ${response.status}`);
+            throw new Error(`Failed to fetch dreams: ${response.status}`);
         }
 
         const data = await response.json();
-        console.log('Loaded insights:', data); // Debug log
-        
-        if (Array.isArray(data.dreams)) {
-            updateInsightsUI(data.dreams);
-        } else {
-            console.error('Invalid insights data format:', data);
+        if (!Array.isArray(data.dreams)) {
+            throw new Error('Invalid dreams data format');
+        }
+        dreams.push(...data.dreams);
+        cursor = data.next_cursor;
+    } while (cursor);
+    return dreams.reverse();
+}
+
+async function loadInsights() {
+    try {
+        const dreams = await fetchAllDreams();
+        if (!dreams) {
+            return;
         }
+        console.log('Loaded insights:', dreams.length, 'dreams'); // Debug log
+        updateInsightsUI(dreams);
     } catch (error) {
         console.error('Error loading insights:', error);
         if (error.message.includes('token')) {
@@ -533,11 +550,17 @@ async function handleDreamSubmit(event) {
             throw new Error('No authentication token found');
         }
 
+        // One key per submission so a retried request cannot save the dream twice
+        const idempotencyKey = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
         const response = await fetch('/add_dream', {
             method: 'POST',
             headers: {
                 'Authorization': `Bearer ${token}`,
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey
             },
             body: JSON.stringify({
                 dream_text: dreamText,
@@ -587,25 +610,12 @@ async function handleDreamSubmit(event) {
 // Updated loadDreams function
 async function loadDreams() {
     try {
-        const response = await authenticatedFetch('/get_dreams');
-        
-        if (!response) {
-            console.log('No response from authenticatedFetch');
+        const dreams = await fetchAllDreams();
+        if (!dreams) {
             return;
         }
-
-        if (!response.ok) {
-            throw new Error(`Failed to fetch dreams: ${response.status}`);
-        }
-
-        const data = await response.json();
-        console.log('Loaded dreams:', data); // Debug log
-        
-        if (Array.isArray(data.dreams)) {
-            updateDreamsUI(data.dreams);
-        } else {
-            console.error('Invalid dreams data format:', data);
-        }
+        console.log('Loaded dreams:', dreams.length); // Debug log
+        updateDreamsUI(dreams);
     } catch (error) {
         console.error('Error loading dreams:', error);
     }
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+
+# Lexicon shipped with the app; set THEME_LEXICON_PATH to use another file
+DEFAULT_LEXICON_PATH = os.environ.get(
+    'THEME_LEXICON_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'theme_lexicon.json')
+)
+
+# One occurrence of a lexicon term; start/end are token positions (end exclusive)
+ThemeMatch = namedtuple('ThemeMatch', ['theme', 'term', 'start', 'end', 'weight'])
+
+# Trie node key holding the (theme, term) pairs that end at the node
+_TERMS = ''
+
+
+def normalize(text):
+    """Tokens of the text as MoodAnalyzer sees them: letters only, lowercased"""
+    return re.sub(r'[^a-zA-Z\s]', '', text).lower().split()
+
+
+class ThemeLexicon:
+    """
+    Weighted dream themes compiled into a token trie. Each theme has a weight
+    and one or more terms (words, inflections or multi-word phrases); a text
+    is matched in a single left-to-right pass over its tokens.
+
+    File format (JSON):
+        {"themes": {"flying": {"weight": 0.8, "terms": ["flying", "flew"]},
+                    "falling": -0.4}}
+    A bare number is the weight of a theme whose only term is its name.
+    """
+
+    def __init__(self, themes):
+        self.weights = {}
+        self.terms = {}
+        self._trie = {}
+        self.max_phrase_length = 0
+        for name, spec in themes.items():
+            if not isinstance(spec, dict):
+                spec = {'weight': spec}
+            self.weights[name] = float(spec['weight'])
+            self.terms[name] = list(spec.get('terms') or [name])
+            for term in self.terms[name]:
+                self._add_term(name, term)
+        self._order = {name: i for i, name in enumerate(self.weights)}
+        self.version = hashlib.sha256(json.dumps(
+            [[name, self.weights[name], self.terms[name]] for name in self.weights]
+        ).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_LEXICON_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f)['themes'])
+
+    def _add_term(self, theme, term):
+        tokens = normalize(term)
+        if not tokens:
+            raise ValueError(f'Theme {theme!r} has an empty term {term!r}')
+        node = self._trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node.setdefault(_TERMS, []).append((theme, term))
+        self.max_phrase_length = max(self.max_phrase_length, len(tokens))
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __contains__(self, theme):
+        return theme in self.weights
+
+    def match(self, tokens):
+        """Every occurrence of every term in the token list, in text order"""
+        matches = []
+        for start in range(len(tokens)):
+            node = self._trie.get(tokens[start])
+            end = start + 1
+            while node is not None:
+                for theme, term in node.get(_TERMS, ()):
+                    matches.append(ThemeMatch(theme, term, start, end, self.weights[theme]))
+                if end == len(tokens):
+                    break
+                node = node.get(tokens[end])
+                end += 1
+        return matches
+
+    def themes(self, tokens):
+        """Distinct themes occurring in the tokens, in lexicon order"""
+        found = {match.theme for match in self.match(tokens)}
+        return sorted(found, key=self._order.__getitem__)
+
+
+_default_lexicon = None
+
+
+def default_lexicon():
+    """The lexicon loaded from DEFAULT_LEXICON_PATH, compiled once per process"""
+    global _default_lexicon
+    if _default_lexicon is None:
+        _default_lexicon = ThemeLexicon.from_file()
+    return _default_lexicon
@@ -0,0 +1,182 @@
+import io
+import logging
+import re
+import numpy as np
+from models import DreamEntry, ThemeModelState
+
+logger = logging.getLogger(__name__)
+
+# Same tokenization as TfidfVectorizer's default token_pattern
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+class IncrementalThemeModel:
+    """
+    Online replacement for refitting TfidfVectorizer + KMeans on every request.
+    Terms are hashed into a fixed number of features, document frequencies are
+    kept as running counts for the IDF, and sequential k-means updates the
+    centroids one document at a time. Each feature remembers its most frequent
+    term so centroids can be reported as keywords.
+    """
+
+    def __init__(self, n_clusters=3, n_features=2 ** 12):
+        self.n_clusters = n_clusters
+        self.n_features = n_features
+        self.n_docs = 0
+        self.doc_freq = np.zeros(n_features, dtype=np.int64)
+        self.centroids = np.zeros((n_clusters, n_features), dtype=np.float64)
+        self.cluster_sizes = np.zeros(n_clusters, dtype=np.int64)
+        self.term_names = np.full(n_features, '', dtype=object)
+        self.term_counts = np.zeros(n_features, dtype=np.int64)
+
+    def _term_counts(self, text):
+        """Hashed raw term counts of one document as {feature: count}"""
+        # Imported here so importing the app does not load scikit-learn
+        from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+        from sklearn.utils import murmurhash3_32
+
+        counts = {}
+        for term in TOKEN_PATTERN.findall(text.lower()):
+            if term in ENGLISH_STOP_WORDS:
+                continue
+            feature = murmurhash3_32(term, positive=True) % self.n_features
+            counts[feature] = counts.get(feature, 0) + 1
+            self._track_term(feature, term)
+        return counts
+
+    def _track_term(self, feature, term):
+        """Keep the majority term of each hashed feature (Misra-Gries with one slot)"""
+        if self.term_names[feature] == term:
+            self.term_counts[feature] += 1
+        elif self.term_counts[feature] == 0:
+            self.term_names[feature] = term
+            self.term_counts[feature] = 1
+        else:
+            self.term_counts[feature] -= 1
+
+    def _vectorize(self, counts):
+        """Smoothed TF-IDF vector (l2 normalized) under the current statistics"""
+        vector = np.zeros(self.n_features, dtype=np.float64)
+        if not counts:
+            return vector
+        features = np.fromiter(counts.keys(), dtype=np.int64)
+        tf = np.fromiter(counts.values(), dtype=np.float64)
+        idf = np.log((1 + self.n_docs) / (1 + self.doc_freq[features])) + 1
+        vector[features] = tf * idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def partial_fit(self, texts):
+        """Fold new documents into the IDF statistics and the clusters"""
+        for text in texts:
+            counts = self._term_counts(text)
+            self.n_docs += 1
+            if counts:
+                self.doc_freq[np.fromiter(counts.keys(), dtype=np.int64)] += 1
+            if not counts:
+                # No usable terms (e.g. all stop words): nothing to cluster
+                continue
+            vector = self._vectorize(counts)
+
+            empty = np.flatnonzero(self.cluster_sizes == 0)
+            if len(empty):
+                # Seed unused clusters with the first distinct documents
+                cluster = empty[0]
+            else:
+                cluster = int(np.argmin(((self.centroids - vector) ** 2).sum(axis=1)))
+
+            self.cluster_sizes[cluster] += 1
+            self.centroids[cluster] += (vector - self.centroids[cluster]) / self.cluster_sizes[cluster]
+        return self
+
+    def themes(self, top_n=3):
+        """Clusters as [{'theme', 'keywords', 'frequency'}], like find_recurring_themes"""
+        themes = []
+        for i in range(self.n_clusters):
+            if not self.cluster_sizes[i]:
+                continue
+            centroid = self.centroids[i]
+            order = np.argsort(centroid)[::-1]
+            keywords = [self.term_names[f] for f in order
+                        if centroid[f] > 0 and self.term_names[f]][:top_n]
+            if not keywords:
+                # Clusters stored before zero vectors were skipped may have no weights
+                continue
+            themes.append({
+                'theme': f"Theme {i + 1}",
+                'keywords': keywords,
+                'frequency': int(self.cluster_sizes[i])
+            })
+        return themes
+
+    def to_bytes(self):
+        buf = io.BytesIO()
+        np.savez_compressed(
+            buf,
+            shape=np.array([self.n_clusters, self.n_features, self.n_docs]),
+            doc_freq=self.doc_freq,
+            centroids=self.centroids,
+            cluster_sizes=self.cluster_sizes,
+            term_names=self.term_names.astype(str),
+            term_counts=self.term_counts
+        )
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        n_clusters, n_features, n_docs = (int(v) for v in arrays['shape'])
+        model = cls(n_clusters, n_features)
+        model.n_docs = n_docs
+        model.doc_freq = arrays['doc_freq']
+        model.centroids = arrays['centroids']
+        model.cluster_sizes = arrays['cluster_sizes']
+        model.term_names = arrays['term_names'].astype(object)
+        model.term_counts = arrays['term_counts']
+        return model
+
+
+def load_user_model(session, user_id):
+    """
+    Return the user's model. Dreams added since it was stored are folded in
+    here rather than on every add_dream, so the write path never rewrites
+    the model; a user without a usable stored model gets one built from all
+    of their dreams. Changes are saved in the caller's transaction.
+    """
+    state = session.get(ThemeModelState, user_id)
+    if state is not None and state.last_dream_id is not None:
+        model = IncrementalThemeModel.from_bytes(state.state)
+        last_dream_id = state.last_dream_id
+    else:
+        # Missing, or stored before the last_dream_id watermark existed
+        model = IncrementalThemeModel()
+        last_dream_id = 0
+
+    rows = session.query(DreamEntry.dream_id, DreamEntry.dream_text).filter(
+        DreamEntry.user_id == user_id,
+        DreamEntry.dream_id > last_dream_id
+    ).order_by(DreamEntry.dream_id).yield_per(1000)
+    n_docs = model.n_docs
+    for row in rows:
+        model.partial_fit([row.dream_text])
+        last_dream_id = row.dream_id
+
+    if state is None or state.last_dream_id is None or model.n_docs != n_docs:
+        save_user_model(session, user_id, model, last_dream_id)
+        logger.info(f"Folded {model.n_docs - n_docs} dreams into the theme model of user {user_id}")
+    return model
+
+
+def save_user_model(session, user_id, model, last_dream_id):
+    """Persist the model in the caller's transaction"""
+    session.merge(ThemeModelState(user_id=user_id, state=model.to_bytes(),
+                                  n_docs=model.n_docs, last_dream_id=last_dream_id))
+
+
+def remove_dream(session, dream):
+    """
+    Drop the owner's model after one of their dreams is deleted; sequential
+    k-means cannot forget a document, so the next load_user_model rebuilds
+    it from the remaining dreams. The caller commits.
+    """
+    session.query(ThemeModelState).filter(ThemeModelState.user_id == dream.user_id).delete()
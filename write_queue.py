@@ -0,0 +1,148 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingWrite:
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Set under GroupCommitWriter._claim_lock: claimed by the writer
+        # thread, or cancelled by a submit() that timed out first
+        self.claimed = False
+        self.cancelled = False
+
+
+class GroupCommitWriter:
+    """
+    Coalesces concurrent writes into shared transactions.
+
+    Callers block in submit() while a dedicated writer thread collects items
+    for up to `flush_interval` seconds (or `max_batch` items), applies each with
+    `apply(session, item)` and commits once. submit() only returns after the
+    commit, so an acknowledged write is as durable as a standalone one. If the
+    shared commit fails, every item is retried in its own transaction so each
+    caller gets its own result or error. A submit() that times out before the
+    writer picks its item up withdraws it, so a timeout means nothing was written.
+    """
+
+    def __init__(self, session_factory, apply, flush_interval=0.005, max_batch=100):
+        self.session_factory = session_factory
+        self.apply = apply
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, item, timeout=30):
+        """
+        Queue an item and wait until it is committed; returns apply()'s result.
+        Raises TimeoutError, with the item withdrawn, if the writer has not
+        started on it within `timeout` seconds.
+        """
+        self._ensure_started()
+        pending = _PendingWrite(item)
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            with self._claim_lock:
+                if not pending.claimed:
+                    pending.cancelled = True
+                    raise TimeoutError('Timed out waiting for the write queue; nothing was written')
+            # Already in a transaction: its outcome decides the response
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _ensure_started(self):
+        # Started lazily so forked server workers each get their own thread
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(
+                        target=self._run, name='group-commit-writer', daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batch = [pending for pending in batch if self._claim(pending)]
+            if batch:
+                self._write_batch(batch)
+
+    def _claim(self, pending):
+        """Take the item for writing unless its submit() already gave up on it"""
+        with self._claim_lock:
+            if pending.cancelled:
+                return False
+            pending.claimed = True
+            return True
+
+    def _write_batch(self, batch):
+        session = self.session_factory()
+        try:
+            results = [self.apply(session, pending.item) for pending in batch]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                self._finish(batch[0], error=e)
+            else:
+                logger.warning(f"Group commit of {len(batch)} writes failed, retrying one by one: {e}")
+                for pending in batch:
+                    self._write_batch([pending])
+            return
+        finally:
+            session.close()
+
+        self.batches += 1
+        self.writes += len(batch)
+        for pending, result in zip(batch, results):
+            self._finish(pending, result=result)
+
+    def _finish(self, pending, result=None, error=None):
+        pending.result = result
+        pending.error = error
+        pending.done.set()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'average_batch_size': self.writes / self.batches if self.batches else 0.0
+        }
+
+
+def writer_from_env(session_factory, apply):
+    """
+    Build a GroupCommitWriter when GROUP_COMMIT=1, else None. Tuned with
+    GROUP_COMMIT_INTERVAL_MS (default 5) and GROUP_COMMIT_MAX_BATCH (default 100).
+    """
+    if os.environ.get('GROUP_COMMIT') != '1':
+        return None
+    return GroupCommitWriter(
+        session_factory,
+        apply,
+        flush_interval=float(os.environ.get('GROUP_COMMIT_INTERVAL_MS', 5)) / 1000,
+        max_batch=int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 100))
+    )